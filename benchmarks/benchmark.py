@@ -0,0 +1,426 @@
+"""End-to-end train/predict benchmark for the machine learning layer
+
+Runs the real giotto.ml.server.rest_api app in process against local stand-ins:
+
+    - A fake BuildingDepot server on 127.0.0.1 that serves OAuth tokens and
+      synthetic timeseries over HTTP, so BuildingDepot requests go through the
+      real helper, session pool, and JSON parsing.
+    - An in-memory MongoDB (mongomock) in place of pymongo.MongoClient.
+
+It creates synthetic virtual sensors, inputs, and samples at a configurable
+scale, trains every sensor through the REST API, and measures single and batch
+predictions. Results are written as JSON so that runs can be compared.
+
+Usage:
+    $ pip install mongomock
+    $ python benchmarks/benchmark.py --sensors 20 --samples 50 --output result.json
+    $ python benchmarks/benchmark.py --baseline result.json
+
+The synthetic signal of every real sensor switches level every SLOT seconds, and
+samples are labeled with the level of their slot, so trained classifiers are
+meaningful and prediction accuracy is reported as a sanity check.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Seconds of one labeled slot of the synthetic signal
+SLOT = 10
+
+# Timestamps of synthetic data start here (2016-01-01 00:00:00 UTC)
+EPOCH = 1451606400
+
+class FakeBuildingDepotHandler(BaseHTTPRequestHandler):
+    '''Serves OAuth tokens and synthetic timeseries like BuildingDepot'''
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one segment so that keep-alive connections do not
+    # stall on Nagle's algorithm and delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith('/oauth/access_token'):
+            self.send_json({'access_token': 'benchmark', 'expires_in': 3600})
+            return
+
+        parts = url.path.split('/')
+        if len(parts) >= 4 and parts[-1] == 'timeseries' and parts[-3] == 'sensor':
+            query = parse_qs(url.query)
+            start_time = float(query['start_time'][0])
+            end_time = float(query['end_time'][0])
+            values = self.server.synthetic_readings(parts[-2], start_time, end_time)
+            self.send_json({'data': {'series': [{'columns': ['time', 'value'], 'values': values}]}})
+            return
+
+        self.send_json({'error': 'not found'}, 404)
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeBuildingDepot(ThreadingMixIn, HTTPServer):
+    '''A fake BuildingDepot server running on a background thread'''
+    daemon_threads = True
+
+    def __init__(self, rate, labels):
+        '''Starts a server on a free local port
+
+        Args:
+            rate: Readings per second of every real sensor
+            labels: The number of signal levels (labels)
+        '''
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeBuildingDepotHandler)
+        self.rate = rate
+        self.labels = labels
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def synthetic_readings(self, uuid, start_time, end_time):
+        '''Returns [timestamp, value] readings of a real sensor between two times'''
+        with self.lock:
+            self.requests += 1
+
+        seed = sum(ord(c) for c in uuid)
+        first = int(math.ceil(start_time * self.rate))
+        last = int(math.floor(end_time * self.rate))
+        readings = []
+        for k in range(first, last + 1):
+            t = float(k) / self.rate
+            level = int(t // SLOT) % self.labels
+            value = level + 0.5 * math.sin(t * (1 + seed % 5)) + 0.1 * ((k * 7919 + seed) % 13 - 6) / 6.0
+            readings.append([t, value])
+
+        return readings
+
+    def setting(self):
+        '''Returns a BuildingDepot setting dictionary pointing at this server'''
+        return {
+            'buildingdepot_rest_api': {
+                'server': 'http://127.0.0.1',
+                'port': str(self.server_address[1]),
+                'api_prefix': '/api'
+            },
+            'oauth': {'id': 'benchmark', 'key': 'benchmark'}
+        }
+
+def percentile(values, q):
+    '''Returns the q-th percentile (0-100) of values with linear interpolation'''
+    if len(values) == 0:
+        return None
+
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100.0
+    lower = int(math.floor(pos))
+    upper = min(lower + 1, len(ordered) - 1)
+
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+def latency_summary(latencies, elapsed):
+    '''Returns latency percentiles in milliseconds and throughput'''
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'elapsed': elapsed
+    }
+
+class Quiet:
+    '''Discards stdout (e.g., prints in classifier.manager) within a block'''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        return False
+
+def load_app(bd, timeseries_cache):
+    '''Imports the REST API app against the stand-ins
+
+    Returns:
+        (app, database_manager)
+    '''
+    try:
+        import mongomock
+        import pymongo
+    except ImportError:
+        sys.exit('The benchmark requires mongomock as an in-memory MongoDB: pip install mongomock')
+
+    pymongo.MongoClient = mongomock.MongoClient
+    try:
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+    except (ImportError, AttributeError):
+        pass
+
+    fd, setting_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(bd.setting(), f)
+    os.environ['GIOTTO_BUILDINGDEPOT_SETTING'] = setting_path
+
+    import giotto.ml.database.manager as database_manager
+    from giotto.ml.database.timeseries_cache import MLTimeseriesCache
+    from giotto.ml.server.rest_api import app
+
+    # The cache is opened on first use, so replace it before any request
+    if timeseries_cache:
+        database_manager.clients['timeseries_cache'] = MLTimeseriesCache(tempfile.mkdtemp(prefix='giotto_benchmark_'))
+    else:
+        database_manager.clients['timeseries_cache'] = None
+
+    return app, database_manager
+
+def call(client, method, url, data=None):
+    '''Calls the REST API and returns the decoded JSON response'''
+    if data is not None:
+        response = getattr(client, method)(url, data=json.dumps(data), content_type='application/json')
+    else:
+        response = getattr(client, method)(url)
+
+    return json.loads(response.data.decode('utf-8'))
+
+def create_sensors(client, args):
+    '''Creates virtual sensors with samples through the REST API
+
+    Returns:
+        An array of (sensor_id, [(start_time, end_time, label)]) tuples
+    '''
+    sensors = []
+    shared_inputs = ['shared-%d' % idx for idx in range(args.shared_inputs)]
+    for sensor_idx in range(args.sensors):
+        inputs = ['input-%d-%d' % (sensor_idx, idx) for idx in range(args.inputs - len(shared_inputs))]
+        sensor = {
+            'name': 'benchmark-%d' % sensor_idx,
+            'user_id': 'default',
+            'labels': ['level-%d' % level for level in range(args.labels)],
+            'inputs': shared_inputs + inputs,
+            'sensor_uuid': '',
+            'description': 'A synthetic virtual sensor'
+        }
+        sensor_id = call(client, 'post', '/sensor', sensor)['ret']
+
+        samples = []
+        for sample_idx in range(args.samples):
+            slot = sample_idx
+            start_time = EPOCH + slot * SLOT + 1
+            end_time = start_time + args.sample_duration
+            label = 'level-%d' % (slot % args.labels)
+            call(client, 'post', '/sensor/%s/sample' % sensor_id,
+                 {'start_time': start_time, 'end_time': end_time, 'label': label})
+            samples.append((start_time, end_time, label))
+
+        sensors.append((sensor_id, samples))
+
+    return sensors
+
+def benchmark_training(client, sensors):
+    '''Trains every sensor through the training job API and measures wall time'''
+    train_times = []
+    started = time.time()
+    for sensor_id, samples in sensors:
+        submitted = time.time()
+        job = call(client, 'post', '/sensor/%s/classifier/train' % sensor_id)['ret']
+        while job['status'] not in ('done', 'error'):
+            time.sleep(0.01)
+            job = call(client, 'get', '/classifier/jobs/%s' % job['job_id'])['ret']
+        if job['status'] != 'done':
+            raise RuntimeError('Training failed: %s' % job['message'])
+        train_times.append(time.time() - submitted)
+    elapsed = time.time() - started
+
+    return {
+        'sensors': len(sensors),
+        'total_seconds': elapsed,
+        'mean_seconds': sum(train_times) / len(train_times),
+        'p50_seconds': percentile(train_times, 50),
+        'max_seconds': max(train_times)
+    }
+
+def prediction_queries(sensors, count, rng):
+    '''Returns random (sensor_id, end_time, expected label) queries within the samples'''
+    queries = []
+    for idx in range(count):
+        sensor_id, samples = sensors[rng.randrange(len(sensors))]
+        start_time, end_time, label = samples[rng.randrange(len(samples))]
+        queries.append((sensor_id, end_time, label))
+
+    return queries
+
+def benchmark_single_predictions(client, queries):
+    '''Measures GET /sensor/<id>/classifier/predict one request at a time'''
+    latencies = []
+    correct = 0
+    started = time.time()
+    for sensor_id, end_time, label in queries:
+        request_started = time.time()
+        result = call(client, 'get', '/sensor/%s/classifier/predict?time=%r' % (sensor_id, end_time))
+        latencies.append(time.time() - request_started)
+        correct += result['ret'] == label
+    elapsed = time.time() - started
+
+    summary = latency_summary(latencies, elapsed)
+    summary['predictions_per_second'] = len(queries) / elapsed
+    summary['accuracy'] = float(correct) / len(queries)
+
+    return summary
+
+def benchmark_batch_predictions(client, queries, batch_size):
+    '''Measures POST /classifiers/predict with batch_size predictions per request'''
+    latencies = []
+    correct = 0
+    started = time.time()
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start+batch_size]
+        data = {'predictions': [{'sensor_id': sensor_id, 'time': end_time} for sensor_id, end_time, label in batch]}
+        request_started = time.time()
+        result = call(client, 'post', '/classifiers/predict', data)
+        latencies.append(time.time() - request_started)
+        correct += sum(ret['ret'] == label for ret, (sensor_id, end_time, label) in zip(result['ret'], batch))
+    elapsed = time.time() - started
+
+    summary = latency_summary(latencies, elapsed)
+    summary['batch_size'] = batch_size
+    summary['predictions_per_second'] = len(queries) / elapsed
+    summary['accuracy'] = float(correct) / len(queries)
+
+    return summary
+
+def stage_totals():
+    '''Returns the count and total seconds of each stage in giotto.helper.metrics'''
+    from giotto.helper import metrics
+
+    totals = {}
+    with metrics.stage_duration.lock:
+        for (name,), series in metrics.stage_duration.series.items():
+            totals[name] = {'count': sum(series[:-1]), 'total_seconds': series[-1]}
+
+    return totals
+
+def environment():
+    '''Returns versions of Python and the main libraries'''
+    env = {'python': platform.python_version(), 'platform': platform.platform()}
+    for name in ('numpy', 'scipy', 'sklearn', 'flask', 'pymongo', 'mongomock'):
+        try:
+            env[name] = __import__(name).__version__
+        except (ImportError, AttributeError):
+            env[name] = None
+
+    return env
+
+def compare(result, baseline):
+    '''Prints ratios of key numbers between a result and a baseline result'''
+    keys = [
+        ('training', 'total_seconds'),
+        ('single_predict', 'p50_ms'),
+        ('single_predict', 'p99_ms'),
+        ('single_predict', 'predictions_per_second'),
+        ('batch_predict', 'p50_ms'),
+        ('batch_predict', 'predictions_per_second'),
+    ]
+    print('%-40s %12s %12s %8s' % ('metric', 'baseline', 'current', 'ratio'))
+    for section, key in keys:
+        old = baseline.get('results', {}).get(section, {}).get(key)
+        new = result['results'].get(section, {}).get(key)
+        if old is None or new is None:
+            continue
+        ratio = new / old if old else float('inf')
+        print('%-40s %12.3f %12.3f %8.2f' % ('%s.%s' % (section, key), old, new, ratio))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sensors', type=int, default=10, help='Virtual sensors to create')
+    parser.add_argument('--inputs', type=int, default=4, help='Real sensors per virtual sensor')
+    parser.add_argument('--shared-inputs', type=int, default=1, help='Real sensors shared by all virtual sensors')
+    parser.add_argument('--samples', type=int, default=30, help='Samples per virtual sensor')
+    parser.add_argument('--sample-duration', type=float, default=5.0, help='Seconds of a sample (at most %d)' % (SLOT - 1))
+    parser.add_argument('--labels', type=int, default=3, help='Labels per virtual sensor')
+    parser.add_argument('--rate', type=float, default=10.0, help='Readings per second of a real sensor')
+    parser.add_argument('--predictions', type=int, default=500, help='Predictions to measure')
+    parser.add_argument('--batch-size', type=int, default=50, help='Predictions per batch request')
+    parser.add_argument('--timeseries-cache', action='store_true', help='Enable the local timeseries cache')
+    parser.add_argument('--seed', type=int, default=0, help='A random seed for prediction queries')
+    parser.add_argument('--output', help='A path to write results as JSON')
+    parser.add_argument('--baseline', help='A path to results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    if args.inputs <= args.shared_inputs:
+        parser.error('--inputs must be larger than --shared-inputs')
+    if args.sample_duration >= SLOT:
+        parser.error('--sample-duration must be shorter than %d seconds' % SLOT)
+
+    bd = FakeBuildingDepot(args.rate, args.labels)
+    app, database_manager = load_app(bd, args.timeseries_cache)
+    client = app.test_client()
+    rng = random.Random(args.seed)
+
+    with Quiet():
+        setup_started = time.time()
+        sensors = create_sensors(client, args)
+        setup_seconds = time.time() - setup_started
+
+        training = benchmark_training(client, sensors)
+        queries = prediction_queries(sensors, args.predictions, rng)
+        single = benchmark_single_predictions(client, queries)
+        batch = benchmark_batch_predictions(client, queries, args.batch_size)
+
+    result = {
+        'timestamp': time.time(),
+        'config': vars(args),
+        'environment': environment(),
+        'results': {
+            'setup_seconds': setup_seconds,
+            'buildingdepot_requests': bd.requests,
+            'training': training,
+            'single_predict': single,
+            'batch_predict': batch,
+            'stages': stage_totals()
+        }
+    }
+
+    print(json.dumps(result['results'], indent=4, sort_keys=True))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+    bd.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Startup-time check for REST API workers
+
+Imports giotto.ml.server.rest_api in fresh Python processes, like a worker does
+when it starts, and reports the wall-clock time of the process and of the import.
+The check fails when the median import time exceeds the budget
+(rest_api.STARTUP_BUDGET by default), or when the import connected to MongoDB,
+InfluxDB, or BuildingDepot, or imported sklearn.
+
+No server is needed: importing the module must not contact any.
+
+Usage:
+    $ python benchmarks/startup.py --runs 5
+    $ python benchmarks/startup.py --budget 0.5 --output startup.json
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs in a fresh process and prints what the import did as JSON
+PROBE = '''
+import sys, json
+import giotto.ml.server.rest_api as rest_api
+import giotto.ml.database.manager as manager
+print(json.dumps({
+    'import_time': rest_api.startup_time,
+    'budget': rest_api.STARTUP_BUDGET,
+    'clients': sorted(manager.clients.keys()),
+    'sklearn': 'sklearn' in sys.modules
+}))
+'''
+
+def probe():
+    '''Imports rest_api in a fresh process
+
+    Returns:
+        A dictionary with 'process_time' (seconds until the process exits) and
+        the values printed by PROBE
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+
+    started = timeit.default_timer()
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', PROBE], env=env, cwd=ROOT)
+    process_time = timeit.default_timer() - started
+
+    result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+    result['process_time'] = process_time
+
+    return result
+
+def median(values):
+    '''Returns the median of values'''
+    values = sorted(values)
+    half = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[half]
+
+    return (values[half - 1] + values[half]) / 2.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes to measure')
+    parser.add_argument('--budget', type=float, help='Seconds allowed for the import (default: rest_api.STARTUP_BUDGET)')
+    parser.add_argument('--output', help='A path to write results as JSON')
+    args = parser.parse_args()
+
+    runs = [probe() for i in range(args.runs)]
+    budget = args.budget if args.budget is not None else runs[0]['budget']
+
+    result = {
+        'runs': args.runs,
+        'budget': budget,
+        'import_time': median([run['import_time'] for run in runs]),
+        'process_time': median([run['process_time'] for run in runs]),
+        'clients': sorted(set(name for run in runs for name in run['clients'])),
+        'sklearn': any(run['sklearn'] for run in runs)
+    }
+    print(json.dumps(result, indent=4, sort_keys=True))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4, sort_keys=True)
+
+    failures = []
+    if result['import_time'] > budget:
+        failures.append('import took %.3f seconds, over the budget of %.3f seconds' % (result['import_time'], budget))
+    if len(result['clients']) > 0:
+        failures.append('clients were created at import: %s' % ', '.join(result['clients']))
+    if result['sklearn']:
+        failures.append('sklearn was imported at import')
+
+    if len(failures) > 0:
+        sys.exit('Startup check failed: ' + '; '.join(failures))
+
+if __name__ == '__main__':
+    main()
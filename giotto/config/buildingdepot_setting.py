@@ -6,3 +6,6 @@ class BuildingDepotSetting:
 
     def get(self, settingName):
         return self.setting[settingName]
+
+    def has(self, settingName):
+        return settingName in self.setting
@@ -3,12 +3,13 @@
 Provides helper methods to post data to Building Depot via its REST APIs
 """
 
-import requests
 import time
 import json
 import time
 import calendar
 from json_setting import JsonSetting
+from giotto.helper.http_session import shared_session
+from giotto.helper.oauth_token import shared_token_manager, DEFAULT_TOKEN_SETTING
 
 class BuildingDepotHelper:
     '''Building Depot Helpe Class'''
@@ -17,10 +18,31 @@ class BuildingDepotHelper:
         setting = JsonSetting(settingFilePath)
         self.bd_rest_api = setting.get('buildingdepot_rest_api')
         self.oauth = setting.get('oauth')
-        self.access_token = self.get_oauth_token()
+
+        # Requests share a pooled keep-alive session (see giotto.helper.http_session).
+        # An optional "http" section in the setting file tunes the pool size,
+        # timeouts, and retries.
+        http_setting = setting.get('http') if setting.has('http') else None
+        self.session = shared_session(http_setting)
+
+        # A token is fetched on first use and refreshed before it expires (see
+        # giotto.helper.oauth_token). Optional keys in the "oauth" section, such as
+        # "refresh_ahead" and "token_cache_file", tune the refresh.
+        token_setting = dict((name, value) for name, value in self.oauth.items() if name in DEFAULT_TOKEN_SETTING)
+        key = '%s:%s/%s' % (self.bd_rest_api['server'], self.bd_rest_api['port'], self.oauth['id'])
+        self.tokens = shared_token_manager(key, self.fetch_oauth_token, token_setting)
 
     def get_oauth_token(self):
-        '''Get OAuth access token'''
+        '''Returns a valid OAuth access token, fetching a new one if necessary'''
+        return self.tokens.token()
+
+    def fetch_oauth_token(self):
+        '''Requests a new OAuth access token
+
+        Returns:
+            (access_token, expires_in): expires_in is None when BuildingDepot does
+                not report it, and both are None on failure
+        '''
         headers = {'content-type': 'application/json'}
         url = self.bd_rest_api['server']
         url += ':' + self.bd_rest_api['port'] 
@@ -28,13 +50,13 @@ class BuildingDepotHelper:
         url += self.oauth['id']
         url += '/client_secret='
         url += self.oauth['key']
-        result = requests.get(url, headers=headers)
+        result = self.session.get(url, headers=headers)
 
         if result.status_code == 200:
             dic = result.json()
-            return dic['access_token']
+            return dic['access_token'], dic.get('expires_in')
         else:
-            return ''
+            return None, None
 
     def get_timeseries_data(self, uuid, start_time, end_time):
         '''Gets time series data
@@ -50,10 +72,6 @@ class BuildingDepotHelper:
         Returns:
             An array consisting of timeseries data 
         '''
-        headers = {
-            'content-type': 'application/json',
-            'Authorization': 'Bearer ' + self.access_token
-            }
         url = self.bd_rest_api['server']
         url += ':' + self.bd_rest_api['port'] 
         url += self.bd_rest_api['api_prefix'] + '/sensor/'
@@ -61,7 +79,14 @@ class BuildingDepotHelper:
         url += 'start_time=' + str(start_time)
         url += '&end_time=' + str(end_time)
 
-        result = requests.get(url, headers=headers)
+        def send(access_token):
+            headers = {
+                'content-type': 'application/json',
+                'Authorization': 'Bearer ' + access_token
+                }
+            return self.session.get(url, headers=headers)
+
+        result = self.tokens.request(send)
         json = result.json()
 
         readings = json['data']['series'][0]
@@ -105,15 +130,20 @@ class BuildingDepotHelper:
             occurred. Check BuildingDepot's document for more details about the 
             return value.
         '''
-        headers = {
-            'content-type': 'application/json',
-            'Authorization': 'Bearer ' + self.access_token
-            }
         url = self.bd_rest_api['server']
         url += ':' + self.bd_rest_api['port'] 
         url += self.bd_rest_api['api_prefix'] + '/sensor/timeseries'
 
-        result = requests.post(url, data=json.dumps(data_array), headers=headers)
+        body = json.dumps(data_array)
+
+        def send(access_token):
+            headers = {
+                'content-type': 'application/json',
+                'Authorization': 'Bearer ' + access_token
+                }
+            return self.session.post(url, data=body, headers=headers)
+
+        result = self.tokens.request(send)
         return result.json()
 
 if __name__ == "__main__":
@@ -16,6 +16,10 @@ class JsonSetting:
         '''Get a value for a given key'''
         return self.setting[settingName]
 
+    def has(self, settingName):
+        '''Checks if a given key exists'''
+        return settingName in self.setting
+
 if __name__ == "__main__":
     settingStringPath = './connector_setting.json'
     self.setting = json.loads(open(settingFilePath,'r').read())
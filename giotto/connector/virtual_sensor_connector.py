@@ -1,41 +1,138 @@
-"""A connector for a virtual sensor script
+"""A connector for virtual sensors
 
-Makes predictions periodically and send them to BuildingDepot
+Makes predictions periodically for many virtual sensors and sends them to
+BuildingDepot. A single process drives all virtual sensors listed in
+connector_setting.json. Sensors are kept in a heap ordered by their next
+prediction time. On each tick, all sensors that are due are predicted together
+in process with giotto.ml.classifier.manager.predict_batch, and the results are
+posted to BuildingDepot with combined post_data_array calls. With
+"streaming_features" enabled (it is disabled by default), features of the latest
+readings are updated incrementally between ticks instead of being recomputed
+from whole windows. The window of each real sensor then ends at its own newest
+reading instead of a time common to all inputs, as in training.
+
+Classifiers are cached in this process, but they are trained and stored by the
+REST API. Each cache hit is checked against the revision of the stored
+classifier (see giotto.ml.database.manager.classifier), so a retrained or deleted
+classifier is picked up on the next tick.
 """
 
 import time
-import math
-import random
+import heapq
 
 from json_setting import JsonSetting
 from buildingdepot_helper import BuildingDepotHelper
 
+class PredictionScheduler:
+    '''Schedules periodic predictions for many virtual sensors'''
+
+    def __init__(self, sensors, predict_batch, post_data_array, user_id='default', post_batch_size=500, streaming=False):
+        '''Initializes a scheduler
+
+        Args:
+            sensors: An array of dictionaries
+                [
+                    {
+                        "sensor_uuid": A UUID of a sensor in BuildingDepot that
+                            receives predictions
+                        "virtual_sensor_id": An object ID of a virtual sensor
+                        "sampling_period": Seconds between predictions
+                    },
+                    { more sensors }
+                ]
+            predict_batch: A function with the signature of
+                giotto.ml.classifier.manager.predict_batch
+            post_data_array: A function with the signature of
+                BuildingDepotHelper.post_data_array
+            user_id: A user ID of a user who own the virtual sensors
+            post_batch_size: The maximum number of sensors in one post_data_array call
+            streaming: True to use streaming features (see predict_batch)
+        '''
+        self.sensors = sensors
+        self.predict_batch = predict_batch
+        self.post_data_array = post_data_array
+        self.user_id = user_id
+        self.post_batch_size = post_batch_size
+        self.streaming = streaming
+
+        # (next prediction time, index of a sensor)
+        now = time.time()
+        self.heap = [(now, idx) for idx in range(len(sensors))]
+        heapq.heapify(self.heap)
+
+    def due_sensors(self, now):
+        '''Pops sensors whose next prediction time has come and reschedules them
+
+        A sensor that missed several periods (e.g., because a tick took long) is
+        predicted once and rescheduled to its next period after now.
+
+        Returns:
+            An array of indexes of the due sensors
+        '''
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            next_time, idx = heapq.heappop(self.heap)
+            period = float(self.sensors[idx]['sampling_period'])
+            while next_time <= now:
+                next_time += period
+            heapq.heappush(self.heap, (next_time, idx))
+            due.append(idx)
+
+        return due
+
+    def tick(self, now):
+        '''Makes predictions for the due sensors and posts them to BuildingDepot
+
+        Returns:
+            The number of posted predictions
+        '''
+        due = self.due_sensors(now)
+        if len(due) == 0:
+            return 0
+
+        queries = [{'sensor_id': self.sensors[idx]['virtual_sensor_id']} for idx in due]
+        clf_results = self.predict_batch(queries, self.user_id, self.streaming)
+
+        data_array = []
+        for idx, clf_result in zip(due, clf_results):
+            if clf_result.result != 'ok':
+                continue
+
+            dic = {}
+            dic['sensor_id'] = self.sensors[idx]['sensor_uuid']
+            dic['samples'] = [{"time":now, "value":clf_result.prediction}]
+            dic['value_type'] = 'string'
+            data_array.append(dic)
+
+        for start in range(0, len(data_array), self.post_batch_size):
+            self.post_data_array(data_array[start:start+self.post_batch_size])
+
+        return len(data_array)
+
+    def run(self):
+        '''Runs ticks until the process exits'''
+        while len(self.heap) > 0:
+            time.sleep(max(0, self.heap[0][0] - time.time()))
+            try:
+                self.tick(time.time())
+            except Exception as e:
+                # Skip this tick. The sensors are already rescheduled
+                print('A tick failed: %s' % e)
+
 if __name__ == "__main__":
-	#Load settings
-
-	connector_setting = JsonSetting('./connector_setting.json')
-	bd_helper = BuildingDepotHelper()
-
-	buildingdepot_uuid = connector_setting.get('sensor_uuid')
-	virtual_sensor_id = connector_setting.get('virtual_sensor_id')
-	sampling_period = connector_setting.get('sampling_period')
-
-	#Make predictions periodically and send them to BD
-	while True:
-		data_array = []
-		timestamp = time.time()
-		
-		#Make prediction
-        url = 'http://localhost:5000/sensor/' + virtual_sensor_id + '/classifier/predict'
-        result = requests.get(url)
-        prediction = result['ret']
-		
-		#Send data
-		dic = {}
-		dic['sensor_id'] = buildingdepot_uuid
-		dic['samples'] = [{"time":timestamp,"value":prediction]
-		dic['value_type'] = 'string'
-		data_array.append(dic)
-
-		result = bd_helper.post_data_array(data_array)
-		time.sleep(sampling_period);
\ No newline at end of file
+    import giotto.ml.classifier.manager as classifier_manager
+
+    #Load settings
+    connector_setting = JsonSetting('./connector_setting.json')
+    bd_helper = BuildingDepotHelper()
+
+    scheduler = PredictionScheduler(
+        connector_setting.get('sensors'),
+        classifier_manager.predict_batch,
+        bd_helper.post_data_array,
+        connector_setting.get('user_id'),
+        connector_setting.get('post_batch_size'),
+        connector_setting.has('streaming_features') and connector_setting.get('streaming_features'))
+
+    #Make predictions periodically and send them to BD
+    scheduler.run()
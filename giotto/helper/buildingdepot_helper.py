@@ -1,18 +1,41 @@
-import requests
 import time
 import json
 import time
 import calendar
 from giotto.config.buildingdepot_setting import BuildingDepotSetting 
+from giotto.helper.http_session import shared_session
+from giotto.helper.oauth_token import shared_token_manager, DEFAULT_TOKEN_SETTING
 
 class BuildingDepotHelper:
     def __init__(self, settingFilePath="../config/buildingdepot_setting.json"):
         setting = BuildingDepotSetting(settingFilePath)
         self.bd_rest_api = setting.get('buildingdepot_rest_api')
         self.oauth = setting.get('oauth')
-        self.access_token = self.get_oauth_token()
+
+        # Requests share a pooled keep-alive session (see giotto.helper.http_session).
+        # An optional "http" section in the setting file tunes the pool size,
+        # timeouts, and retries.
+        http_setting = setting.get('http') if setting.has('http') else None
+        self.session = shared_session(http_setting)
+
+        # A token is fetched on first use and refreshed before it expires (see
+        # giotto.helper.oauth_token). Optional keys in the "oauth" section, such as
+        # "refresh_ahead" and "token_cache_file", tune the refresh.
+        token_setting = dict((name, value) for name, value in self.oauth.items() if name in DEFAULT_TOKEN_SETTING)
+        key = '%s:%s/%s' % (self.bd_rest_api['server'], self.bd_rest_api['port'], self.oauth['id'])
+        self.tokens = shared_token_manager(key, self.fetch_oauth_token, token_setting)
 
     def get_oauth_token(self):
+        '''Returns a valid OAuth access token, fetching a new one if necessary'''
+        return self.tokens.token()
+
+    def fetch_oauth_token(self):
+        '''Requests a new OAuth access token
+
+        Returns:
+            (access_token, expires_in): expires_in is None when BuildingDepot does
+                not report it, and both are None on failure
+        '''
         headers = {'content-type': 'application/json'}
         url = self.bd_rest_api['server']
         url += ':' + self.bd_rest_api['port'] 
@@ -20,19 +43,34 @@ class BuildingDepotHelper:
         url += self.oauth['id']
         url += '/client_secret='
         url += self.oauth['key']
-        result = requests.get(url, headers=headers)
+        result = self.session.get(url, headers=headers)
 
         if result.status_code == 200:
             dic = result.json()
-            return dic['access_token']
+            return dic['access_token'], dic.get('expires_in')
         else:
-            return ''
+            return None, None
 
     def get_timeseries_data(self, uuid, start_time, end_time):
-        headers = {
-            'content-type': 'application/json',
-            'Authorization': 'Bearer ' + self.access_token
-            }
+        timestamps, data = self.get_timeseries(uuid, start_time, end_time)
+
+        return data
+
+    def get_timeseries(self, uuid, start_time, end_time):
+        '''Gets time series data with timestamps
+
+        Gets time series data for a sensor with given UUID in BuildingDepot between
+        start_time and end_time.
+
+        Args:
+            uuid: A UUID of a sensor
+            start_time: A unix timestamp
+            end_time: A unix timestamp
+
+        Returns:
+            (timestamps, data): An array of unix timestamps and an array of
+                readings at these timestamps
+        '''
         url = self.bd_rest_api['server']
         url += ':' + self.bd_rest_api['port'] 
         url += self.bd_rest_api['api_prefix'] + '/sensor/'
@@ -40,19 +78,50 @@ class BuildingDepotHelper:
         url += 'start_time=' + str(start_time)
         url += '&end_time=' + str(end_time)
 
-        result = requests.get(url, headers=headers)
+        def send(access_token):
+            headers = {
+                'content-type': 'application/json',
+                'Authorization': 'Bearer ' + access_token
+                }
+            return self.session.get(url, headers=headers)
+
+        result = self.tokens.request(send)
         json = result.json()
 
         readings = json['data']['series'][0]
         columns = readings['columns']
         values = readings['values']
+        time_index = columns.index('time')
         index = columns.index('value')
 
+        timestamps = []
         data = []
         for value in values:
+            timestamps.append(parse_timestamp(value[time_index]))
             data.append(value[index])
 
-        return data
+        return timestamps, data
+
+def parse_timestamp(value):
+    '''Converts a timestamp from BuildingDepot to a unix timestamp
+
+    Args:
+        value: A unix timestamp, or a RFC3339 string in UTC
+            (e.g., 2016-04-06T19:45:53.25Z)
+
+    Returns:
+        A unix timestamp float
+    '''
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    t = calendar.timegm(time.strptime(value[0:19], "%Y-%m-%dT%H:%M:%S"))
+
+    fraction = value[19:].rstrip('Z')   # e.g., .25
+    if fraction.startswith('.'):
+        t += float('0' + fraction)
+
+    return float(t)
 
 if __name__ == "__main__":
     bd_helper = BuildingDepotHelper()
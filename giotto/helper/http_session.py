@@ -0,0 +1,93 @@
+"""Pooled HTTP sessions
+
+Provides keep-alive HTTP sessions with connection pooling, timeouts, and
+bounded retries. Helpers that talk to BuildingDepot share a session per
+process so that requests reuse warm connections instead of opening a new
+TCP/TLS connection for every call.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Default values used when a setting file has no "http" section
+DEFAULT_HTTP_SETTING = {
+    'pool_size': 10,            # Connections kept alive per host
+    'connect_timeout': 3.05,    # Seconds to wait for a connection
+    'read_timeout': 30,         # Seconds to wait for a response
+    'max_retries': 3,           # Retries on connection errors and 5xx responses
+    'backoff_factor': 0.3       # Sleeps backoff_factor * 2^(retry - 1) seconds between retries
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+class HTTPSession:
+    '''A keep-alive HTTP session with a connection pool, timeouts, and retries
+
+    Idempotent requests (e.g., GET) are retried on connection errors and on
+    502, 503, and 504 responses. Non-idempotent requests (e.g., POST) are only
+    retried when a connection could not be established. When the retries of a
+    5xx response run out, the last response is returned, as without retries.
+    '''
+    def __init__(self, setting=None):
+        '''Creates a session
+
+        Args:
+            setting: A dictionary that overrides values in DEFAULT_HTTP_SETTING
+        '''
+        self.setting = dict(DEFAULT_HTTP_SETTING)
+        if setting is not None:
+            self.setting.update(setting)
+
+        self.timeout = (self.setting['connect_timeout'], self.setting['read_timeout'])
+
+        retry = Retry(
+            total=self.setting['max_retries'],
+            backoff_factor=self.setting['backoff_factor'],
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=self.setting['pool_size'],
+            pool_maxsize=self.setting['pool_size'],
+            max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        '''Sends a GET request with the session's default timeout'''
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        '''Sends a POST request with the session's default timeout'''
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        '''Closes all pooled connections'''
+        self.session.close()
+
+def shared_session(setting=None):
+    '''Returns a process-wide HTTPSession for given settings
+
+    Callers passing the same settings get the same session, and thus share
+    its connection pool.
+
+    Args:
+        setting: A dictionary that overrides values in DEFAULT_HTTP_SETTING
+
+    Returns:
+        An HTTPSession instance
+    '''
+    key = tuple(sorted((setting or {}).items()))
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = HTTPSession(setting)
+            _sessions[key] = session
+
+        return session
@@ -0,0 +1,182 @@
+"""A lightweight metrics registry
+
+Keeps counters and latency histograms in process memory and renders them in the
+Prometheus text exposition format. Recording a value takes a lock and a bisect
+over a short list of bucket bounds, so metrics can stay enabled in production.
+
+Usage:
+    from giotto.helper import metrics
+
+    with metrics.stage('preprocess'):
+        features = classifier.preprocess(timeseries)
+
+    print(metrics.registry.render())
+"""
+import bisect
+import threading
+import timeit
+
+# Upper bounds of latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape_label_value(value):
+    '''Escapes a label value for the Prometheus text format'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=None):
+    '''Returns a label set such as {stage="preprocess"}, or '' without labels'''
+    pairs = ['%s="%s"' % (name, escape_label_value(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if len(pairs) == 0:
+        return ''
+
+    return '{' + ','.join(pairs) + '}'
+
+def format_value(value):
+    '''Formats a number for the Prometheus text format'''
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+
+    return repr(float(value))
+
+class Counter:
+    '''A monotonically increasing counter with labels'''
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}    # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        '''Increments the counter of given label values'''
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        '''Returns lines in the Prometheus text format'''
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s counter' % self.name
+        ]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.label_names, label_values), format_value(value)))
+
+        return lines
+
+class Histogram:
+    '''A histogram of observed values with labels
+
+    Counts are kept per bucket and summed cumulatively when rendered.
+    '''
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}    # label values -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_values=()):
+        '''Records a value for given label values'''
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = [0] * (len(self.buckets) + 1) + [0.0]
+                self.series[label_values] = series
+            series[idx] += 1
+            series[-1] += value
+
+    def time(self, label_values=()):
+        '''Returns a context manager that observes the duration of its block'''
+        return Timer(self, label_values)
+
+    def render(self):
+        '''Returns lines in the Prometheus text format'''
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s histogram' % self.name
+        ]
+        with self.lock:
+            snapshot = sorted((label_values, list(series)) for label_values, series in self.series.items())
+
+        for label_values, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, ('le', format_value(bound)))
+                lines.append('%s_bucket%s %d' % (self.name, labels, cumulative))
+            labels = format_labels(self.label_names, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels, format_value(series[-1])))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+
+        return lines
+
+class Timer:
+    '''A context manager that observes the duration of its block in a histogram'''
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(timeit.default_timer() - self.started, self.label_values)
+        return False
+
+class MetricsRegistry:
+    '''A collection of metrics rendered together'''
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        '''Adds a metric and returns it'''
+        with self.lock:
+            self.metrics.append(metric)
+
+        return metric
+
+    def render(self):
+        '''Returns all metrics in the Prometheus text format'''
+        with self.lock:
+            metrics = list(self.metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+stage_duration = registry.register(Histogram(
+    'giotto_stage_duration_seconds',
+    'Time spent in a processing stage of the machine learning layer',
+    ('stage',)))
+
+http_requests = registry.register(Counter(
+    'giotto_http_requests_total',
+    'HTTP requests handled by the machine learning layer',
+    ('endpoint', 'method', 'status')))
+
+http_request_duration = registry.register(Histogram(
+    'giotto_http_request_duration_seconds',
+    'Latency of HTTP requests handled by the machine learning layer',
+    ('endpoint', 'method')))
+
+def stage(name):
+    '''Returns a context manager that records the duration of a stage
+
+    Args:
+        name: A name of a stage, e.g., 'preprocess'
+    '''
+    return stage_duration.time((name,))
@@ -0,0 +1,326 @@
+"""OAuth access tokens with expiry tracking and refresh
+
+Keeps an OAuth access token for BuildingDepot together with its expiry time.
+
+    - A token is fetched on first use, not when a helper is created.
+    - A token close to its expiry is refreshed on a background thread while
+      callers keep using the current one.
+    - A request rejected with 401 is retried once with a refreshed token. The
+      refresh is single-flight: callers that fail with the same token wait for
+      one refresh instead of each requesting a new token.
+    - Optionally, tokens are shared with other local processes (e.g., the
+      connector and REST API workers) through a cache file, so a new process
+      reuses a valid token instead of fetching its own.
+
+Usage:
+    tokens = shared_token_manager(key, fetch, setting)
+    response = tokens.request(lambda token: session.get(url, headers={
+        'Authorization': 'Bearer ' + token}))
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # Refreshes are not coordinated across processes
+
+from giotto.helper import metrics
+
+# Default values used when the "oauth" section of a setting file omits them
+DEFAULT_TOKEN_SETTING = {
+    'refresh_ahead': 60,        # Seconds before expiry when a background refresh starts
+    'default_expires_in': 3600, # Seconds a token lasts when the server does not say
+    'retry_interval': 5,        # Seconds before a failed fetch is tried again
+    'token_cache_file': None    # A path of a file shared by local processes, or None
+}
+
+# The largest part of a token's lifetime that refresh_ahead may take. A token
+# that lasts less than refresh_ahead seconds is refreshed when this part is left,
+# instead of on every use.
+REFRESH_AHEAD_FRACTION = 0.5
+
+token_refreshes = metrics.registry.register(metrics.Counter(
+    'giotto_oauth_token_refreshes_total',
+    'OAuth access tokens fetched from BuildingDepot or adopted from the token cache file',
+    ('reason', 'source')))
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+class OAuthTokenManager:
+    '''Keeps an OAuth access token and refreshes it'''
+    def __init__(self, key, fetch, setting=None):
+        '''Initializes a manager. No token is fetched until one is needed.
+
+        Args:
+            key: A string that identifies the token (e.g., a server and a client
+                ID). Tokens in the cache file are only used for the same key.
+            fetch: A function that requests a new token and returns
+                (access_token, expires_in), where expires_in is seconds or None.
+                It returns (None, None) or raises an exception on failure.
+            setting: A dictionary that overrides values in DEFAULT_TOKEN_SETTING
+        '''
+        self.key = key
+        self.fetch = fetch
+        self.setting = dict(DEFAULT_TOKEN_SETTING)
+        if setting is not None:
+            self.setting.update(setting)
+
+        self.access_token = None
+        self.expires_at = 0.0
+        self.refresh_at = 0.0                   # A background refresh starts after this time
+        self.retry_at = 0.0                     # No refresh is tried before this time
+        self.lock = threading.Lock()            # Guards the token and the times above
+        self.refresh_lock = threading.Lock()    # Makes refreshes single-flight
+        self.background = None                  # A running background refresh thread
+
+    def token(self):
+        '''Returns a valid access token
+
+        Fetches a token when there is none or it has expired. Starts a background
+        refresh when the token expires within refresh_ahead seconds (at most
+        REFRESH_AHEAD_FRACTION of its lifetime).
+
+        Returns:
+            An access token, or '' if no token could be fetched
+        '''
+        with self.lock:
+            access_token = self.access_token
+            expires_at = self.expires_at
+            refresh_at = self.refresh_at
+            retry_at = self.retry_at
+
+        now = time.time()
+        if now >= expires_at:
+            return self.refresh(access_token, 'expired')
+
+        if access_token is None:
+            # The last fetch failed. Wait for retry_at.
+            return ''
+
+        if now >= refresh_at and now >= retry_at:
+            self.refresh_in_background(access_token)
+
+        return access_token
+
+    def refresh(self, stale=None, reason='unauthorized'):
+        '''Replaces a stale token with a new one
+
+        Only one thread refreshes at a time. A thread that waited for another
+        refresh returns the token it fetched instead of fetching again. After a
+        failed fetch, no token is fetched again until retry_interval passes.
+
+        Args:
+            stale: The token that expired or was rejected, or None
+            reason: Why the token is refreshed, recorded in token_refreshes
+
+        Returns:
+            A new access token, or '' if no token could be fetched
+        '''
+        with self.refresh_lock:
+            with self.lock:
+                if self.access_token is not None and self.access_token != stale and time.time() < self.expires_at:
+                    return self.access_token
+                if time.time() < self.retry_at:
+                    # A recent fetch failed, possibly while this thread waited
+                    return self.access_token or ''
+
+            with self.file_lock():
+                access_token, expires_at, refresh_at = self.read_cache_file()
+                if access_token is not None and access_token != stale:
+                    source = 'cache_file'
+                else:
+                    access_token, expires_at, refresh_at = self.fetch_token()
+                    source = 'server'
+                    if access_token is not None:
+                        self.write_cache_file(access_token, expires_at, refresh_at)
+
+            if access_token is None:
+                # Keep the current token, and try again after retry_interval. An
+                # expired or rejected token is kept until then, so that callers do
+                # not retry the fetch on every request.
+                with self.lock:
+                    self.retry_at = time.time() + self.setting['retry_interval']
+                    if reason != 'ahead':
+                        self.expires_at = self.retry_at
+                    return self.access_token or ''
+
+            token_refreshes.inc((reason, source))
+            with self.lock:
+                self.access_token = access_token
+                self.expires_at = expires_at
+                self.refresh_at = refresh_at
+
+            return access_token
+
+    def refresh_in_background(self, stale):
+        '''Starts a thread that refreshes a token unless one is running'''
+        with self.lock:
+            if self.background is not None and self.background.is_alive():
+                return
+
+            def run():
+                try:
+                    self.refresh(stale, 'ahead')
+                except Exception as e:
+                    print('A background token refresh failed: %s' % e)
+
+            self.background = threading.Thread(target=run)
+            self.background.daemon = True
+            self.background.start()
+
+    def request(self, send):
+        '''Sends a request with a token, and retries once with a new token on 401
+
+        The request is not retried when no new token could be fetched.
+
+        Args:
+            send: A function send(access_token) that sends a request and returns
+                a response with status_code
+
+        Returns:
+            A response returned by send
+        '''
+        access_token = self.token()
+        response = send(access_token)
+        if response.status_code == 401 and access_token != '':
+            new_token = self.refresh(access_token)
+            if new_token != '' and new_token != access_token:
+                response = send(new_token)
+
+        return response
+
+    def fetch_token(self):
+        '''Fetches a new token from the server
+
+        Returns:
+            (access_token, expires_at, refresh_at), or (None, None, None) on failure
+        '''
+        try:
+            access_token, expires_in = self.fetch()
+        except Exception as e:
+            print('Could not fetch an OAuth token: %s' % e)
+            return None, None, None
+
+        if not access_token:
+            return None, None, None
+
+        if expires_in is None:
+            expires_in = self.setting['default_expires_in']
+
+        expires_in = float(expires_in)
+        ahead = min(self.setting['refresh_ahead'], expires_in*REFRESH_AHEAD_FRACTION)
+        now = time.time()
+
+        return access_token, now + expires_in, now + expires_in - ahead
+
+    def file_lock(self):
+        '''Returns a context manager that holds an exclusive lock on the cache file'''
+        return FileLock(self.setting['token_cache_file'])
+
+    def read_cache_file(self):
+        '''Returns (access_token, expires_at, refresh_at) of a valid cached token,
+        or (None, None, None)'''
+        path = self.setting['token_cache_file']
+        if path is None:
+            return None, None, None
+
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f).get(self.key)
+        except (IOError, OSError, ValueError):
+            return None, None, None
+
+        if entry is None:
+            return None, None, None
+
+        refresh_at = entry.get('refresh_at', entry['expires_at'] - self.setting['refresh_ahead'])
+        if time.time() >= refresh_at:
+            return None, None, None
+
+        return entry['access_token'], entry['expires_at'], refresh_at
+
+    def write_cache_file(self, access_token, expires_at, refresh_at):
+        '''Stores a token in the cache file, keeping tokens of other keys'''
+        path = self.setting['token_cache_file']
+        if path is None:
+            return
+
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            entries = {}
+
+        entries[self.key] = {
+            'access_token': access_token,
+            'expires_at': expires_at,
+            'refresh_at': refresh_at
+        }
+
+        # Write a private temporary file and rename it, so that readers never
+        # see a partial file
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            fd, temporary = tempfile.mkstemp(dir=directory, prefix='.oauth_token')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(temporary, path)
+        except (IOError, OSError) as e:
+            print('Could not write the token cache file: %s' % e)
+
+class FileLock:
+    '''An exclusive lock on a file next to a token cache file
+
+    Serializes token refreshes of local processes. Does nothing without a cache
+    file or where fcntl is not available.
+    '''
+    def __init__(self, path):
+        self.path = path + '.lock' if path is not None else None
+        self.file = None
+
+    def __enter__(self):
+        if self.path is None or fcntl is None:
+            return self
+
+        try:
+            self.file = open(self.path, 'a')
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        except (IOError, OSError) as e:
+            print('Could not lock the token cache file: %s' % e)
+            self.file = None
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+        return False
+
+def shared_token_manager(key, fetch, setting=None):
+    '''Returns a process-wide OAuthTokenManager for a key
+
+    Helpers created for the same server and client share one token.
+
+    Args:
+        key: A string that identifies the token
+        fetch: A function that fetches a token (see OAuthTokenManager)
+        setting: A dictionary that overrides values in DEFAULT_TOKEN_SETTING
+
+    Returns:
+        An OAuthTokenManager instance
+    '''
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = OAuthTokenManager(key, fetch, setting)
+            _managers[key] = manager
+
+        return manager
@@ -0,0 +1,155 @@
+"""On-demand profiling of single requests
+
+Profiles chosen requests with cProfile and keeps the most recent profiles in
+memory. Each profile keeps a summary of its top hotspots and the raw pstats data,
+which can be downloaded and opened with pstats or a viewer such as snakeviz.
+
+Usage:
+    profiler = RequestProfiler()
+
+    profile = profiler.start()
+    ... handle a request ...
+    profiler.finish(profile, url, method, endpoint, status)
+"""
+import time
+import uuid
+import pstats
+import marshal
+import cProfile
+import threading
+from collections import OrderedDict
+
+class RequestProfile:
+    '''A cProfile profile of one request'''
+    def __init__(self):
+        self.profile_id = uuid.uuid4().hex
+        self.profiler = cProfile.Profile()
+        self.started_at = time.time()
+        self.duration = None
+        self.url = None
+        self.method = None
+        self.endpoint = None
+        self.status = None
+        self.hotspots = []
+        self.stats = None   # Raw pstats data as a dictionary
+
+    def summary(self):
+        '''Returns a dictionary describing the profile without hotspots'''
+        return {
+            'profile_id': self.profile_id,
+            'url': self.url,
+            'method': self.method,
+            'endpoint': self.endpoint,
+            'status': self.status,
+            'started_at': self.started_at,
+            'duration': self.duration
+        }
+
+    def to_dictionary(self):
+        '''Returns a dictionary representation of a RequestProfile instance'''
+        dic = self.summary()
+        dic['hotspots'] = self.hotspots
+
+        return dic
+
+    def dump(self):
+        '''Returns the raw pstats data in the format written by pstats.Stats.dump_stats'''
+        return marshal.dumps(self.stats)
+
+class RequestProfiler:
+    '''Profiles requests and keeps the recent profiles
+
+    cProfile only observes the thread that handles a request. Work done on other
+    threads (e.g., parallel BuildingDepot fetches) shows up as time spent waiting
+    for them in the request's thread.
+    '''
+    def __init__(self, history=50, top=25):
+        '''Initializes a profiler
+
+        Args:
+            history: The number of recent profiles kept
+            top: The number of hotspots kept in a profile summary
+        '''
+        self.history = history
+        self.top = top
+        self.profiles = OrderedDict()   # profile_id -> RequestProfile
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''Starts profiling the current thread
+
+        Returns:
+            A RequestProfile instance to pass to finish
+        '''
+        profile = RequestProfile()
+        profile.profiler.enable()
+
+        return profile
+
+    def finish(self, profile, url, method, endpoint, status):
+        '''Stops profiling and stores a profile with its hotspots
+
+        Args:
+            profile: A RequestProfile instance returned by start
+            url: A URL of the request
+            method: An HTTP method of the request
+            endpoint: A URL rule of the request
+            status: An HTTP status code of the response
+        '''
+        profile.profiler.disable()
+        profile.duration = time.time() - profile.started_at
+        profile.url = url
+        profile.method = method
+        profile.endpoint = endpoint
+        profile.status = status
+
+        stats = pstats.Stats(profile.profiler)
+        profile.stats = stats.stats
+        profile.hotspots = hotspots(stats.stats, self.top)
+        profile.profiler = None
+
+        with self.lock:
+            self.profiles[profile.profile_id] = profile
+            while len(self.profiles) > self.history:
+                self.profiles.popitem(last=False)
+
+    def profile(self, profile_id):
+        '''Returns a stored profile, or None if no profile has a given ID'''
+        with self.lock:
+            return self.profiles.get(profile_id)
+
+    def recent(self):
+        '''Returns summaries of the stored profiles from the newest to the oldest'''
+        with self.lock:
+            profiles = list(self.profiles.values())
+
+        return [profile.summary() for profile in reversed(profiles)]
+
+def hotspots(stats, top):
+    '''Returns the functions that took the most time in pstats data
+
+    Args:
+        stats: A dictionary of pstats data, {(file, line, function): (primitive
+            calls, calls, self time, cumulative time, callers)}
+        top: The number of functions to return
+
+    Returns:
+        An array of dictionaries sorted by self time in descending order
+            [
+                {
+                    'function': "file:line(function)"
+                    'calls': The number of calls
+                    'self_time': Seconds spent in the function itself
+                    'cumulative_time': Seconds spent in the function and its callees
+                },
+                { more functions }
+            ]
+    '''
+    entries = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+
+    return [{
+        'function': '%s:%d(%s)' % func,
+        'calls': calls,
+        'self_time': self_time,
+        'cumulative_time': cumulative_time
+    } for func, (primitive_calls, calls, self_time, cumulative_time, callers) in entries]
@@ -0,0 +1,165 @@
+"""Asynchronous training jobs
+
+Training a classifier loads a training set, extracts features, fits a model, and
+stores it, which can take longer than an HTTP request should. This module runs
+training as jobs on a bounded pool of background worker threads and keeps their
+status so that clients can poll it.
+"""
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class MLTrainingJob:
+    '''A container class to hold the status of a training job'''
+    def __init__(self, sensor_id, user_id, tune=False):
+        self.job_id = uuid.uuid4().hex
+        self.sensor_id = sensor_id
+        self.user_id = user_id
+        self.tune = tune            # True if hyperparameters are searched
+        self.status = 'queued'      # queued, running, done, or error
+        self.stage = ''             # A stage reported by the training function
+        self.progress = 0.0         # Progress between 0 and 1
+        self.message = ''
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def finished(self):
+        '''Returns True if the job is done or failed'''
+        return self.status in ('done', 'error')
+
+    def to_dictionary(self):
+        '''Returns a dictionary representation of a MLTrainingJob instance'''
+        now = time.time()
+        if self.started_at is None:
+            wait_time = now - self.submitted_at
+            run_time = 0.0
+        else:
+            wait_time = self.started_at - self.submitted_at
+            run_time = (self.finished_at or now) - self.started_at
+
+        return {
+            'job_id': self.job_id,
+            'sensor_id': self.sensor_id,
+            'user_id': self.user_id,
+            'tune': self.tune,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'message': self.message,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'wait_time': wait_time,
+            'run_time': run_time
+        }
+
+class MLTrainingQueue:
+    '''A job queue that runs training on a bounded pool of worker threads
+
+    Only one job per virtual sensor is queued or running at a time. Submitting
+    a sensor that already has an unfinished job returns the existing job.
+    '''
+    def __init__(self, train, workers=2, history=1000):
+        '''Initializes a queue. Worker threads start on the first submission.
+
+        Args:
+            train: A function train(sensor_id, user_id, progress, tune) that returns
+                a MLClassifierResult. progress(stage, fraction) reports progress.
+            workers: The number of worker threads
+            history: The number of finished jobs whose status is kept
+        '''
+        self.train = train
+        self.workers = workers
+        self.history = history
+        self.queue = queue.Queue()
+        self.jobs = OrderedDict()   # job_id -> MLTrainingJob in submission order
+        self.active = {}            # (user_id, sensor_id) -> unfinished MLTrainingJob
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def submit(self, sensor_id, user_id, tune=False):
+        '''Submits a training job for a virtual sensor
+
+        Args:
+            sensor_id: An object ID of a virtual sensor
+            user_id: A user ID of a user who own the virtual sensor
+            tune: A flag passed to the training function. It is ignored when an
+                unfinished job is returned.
+
+        Returns:
+            A MLTrainingJob instance, which may be an existing unfinished job
+        '''
+        self.start()
+
+        key = (user_id, sensor_id)
+        with self.lock:
+            job = self.active.get(key)
+            if job is not None:
+                return job
+
+            job = MLTrainingJob(sensor_id, user_id, tune)
+            self.jobs[job.job_id] = job
+            self.active[key] = job
+            self.forget_old_jobs()
+
+        self.queue.put(job)
+
+        return job
+
+    def job(self, job_id):
+        '''Returns a job, or None if no job has a given ID'''
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def forget_old_jobs(self):
+        '''Drops the oldest finished jobs beyond the history size
+
+        The caller must hold self.lock.
+        '''
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished()]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def run(self):
+        '''Runs jobs from the queue until the process exits'''
+        while True:
+            job = self.queue.get()
+            self.run_job(job)
+
+    def run_job(self, job):
+        '''Runs a training job and records its result'''
+        def progress(stage, fraction):
+            job.stage = stage
+            job.progress = fraction
+
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            clf_result = self.train(job.sensor_id, job.user_id, progress, job.tune)
+            job.status = 'done' if clf_result.result == 'ok' else 'error'
+            job.message = clf_result.message
+        except Exception as e:
+            job.status = 'error'
+            job.message = 'Training failed: %s' % e
+        finally:
+            job.finished_at = time.time()
+            if job.status == 'done':
+                job.progress = 1.0
+            with self.lock:
+                self.active.pop((job.user_id, job.sensor_id), None)
+
+    def start(self):
+        '''Starts worker threads if they are not running'''
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
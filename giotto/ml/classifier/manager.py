@@ -1,9 +1,13 @@
 import giotto.ml.database.manager as db_manager
 from giotto.ml.database.sensor import MLSensor
 from giotto.ml.database.classifier import MLClassifier
+from giotto.ml.classifier.jobs import MLTrainingQueue
+from giotto.helper import metrics
 
 import time
+import numpy as np
 from datetime import timedelta
+from bson.errors import InvalidId
 
 class MLClassifierResult:
     '''A container class to hold results from giotto.ml.classifier.manager module'''
@@ -11,8 +15,9 @@ class MLClassifierResult:
         self.result = "ok"
         self.message = ''
         self.value = None
+        self.prediction = None
 
-def train(sensor_id, user_id):
+def train(sensor_id, user_id, progress=None, tune=False):
     '''Trains a classifier for a virtual sensor
 
     Trains a classifier for a virtual sensor using its samples as a training set.
@@ -25,28 +30,47 @@ def train(sensor_id, user_id):
     Args:
         sensor_id: An object ID of a virtual sensor
         user_id: A user ID of a user who own this virtual sensor
+        progress: An optional function progress(stage, fraction) called when
+            each stage of training starts. fraction is between 0 and 1.
+        tune: A flag that indicates if hyperparameters are searched before
+            training (see MLClassifier.tune). Otherwise, the parameters of the
+            stored classifier are kept.
 
     Returns:
         cls_result: An instance of a container class MLClassifierResult
     '''
     clf_result = MLClassifierResult()
+    if progress is None:
+        progress = lambda stage, fraction: None
 
     # Load classifier. If no classifier is stored, create a new one
-    classifier = db_manager.classifier(sensor_id, user_id)
+    # The cached instance is shared with predictions and holds only the compiled
+    # forest, so load a private copy with the pickled forest
+    classifier = db_manager.classifier(sensor_id, user_id, cached=False, compiled=False)
     if classifier is None:
         classifier = MLRandomForest()
         classifier.sensor_id = sensor_id
         classifier.user_id = user_id
 
     # Load a training set from a database
-    dataset = db_manager.dataset(sensor_id, user_id)
+    # Features of samples from previous training runs are reused, so only new
+    # samples are fetched and preprocessed
+    progress('loading', 0.1)
+    dataset = db_manager.dataset(sensor_id, user_id, classifier.FEATURE_VERSION)
     if dataset is None:
         clf_result.result = 'error'
         clf_result.message = 'No samples in a training set'
         return clf_result
 
+    if tune:
+        progress('tuning', 0.3)
+        classifier.tune(dataset)
+
     # Train a classifier and store it in a database
+    progress('training', 0.5)
     classifier.train(dataset)
+    progress('storing', 0.9)
+    db_manager.store_features(sensor_id, user_id, dataset)
     result = db_manager.store_classifier(classifier)
     if result is None:
         clf_result.result = 'error'
@@ -55,6 +79,31 @@ def train(sensor_id, user_id):
 
     return clf_result
 
+# Training requests are run in the background by a pool of worker threads
+TRAINING_WORKERS = 2
+training_queue = MLTrainingQueue(train, TRAINING_WORKERS)
+
+def submit_training(sensor_id, user_id, tune=False):
+    '''Submits a training job for a virtual sensor
+
+    Runs train in the background (see giotto.ml.classifier.jobs). When the
+    virtual sensor already has a queued or running job, the job is returned
+    instead of submitting a new one.
+
+    Args:
+        sensor_id: An object ID of a virtual sensor
+        user_id: A user ID of a user who own this virtual sensor
+        tune: A flag that indicates if hyperparameters are searched (see train)
+
+    Returns:
+        A MLTrainingJob instance
+    '''
+    return training_queue.submit(sensor_id, user_id, tune)
+
+def training_job(job_id):
+    '''Returns a training job, or None if no job has a given ID'''
+    return training_queue.job(job_id)
+
 def predict(sensor_id, user_id, end_time=None):    
     '''Makes a prediction with a virtual sensor
 
@@ -102,6 +151,167 @@ def predict(sensor_id, user_id, end_time=None):
 
     return clf_result
 
+def predict_batch(queries, user_id, streaming=False):
+    '''Makes predictions for many virtual sensors and time windows at once
+
+    Each query is a virtual sensor and an end time, as in predict. Timeseries data
+    for all queries is fetched together, so a real sensor used by several queries
+    is fetched once per time range (see db_manager.timeseries_for_queries). Then,
+    the predictions of each virtual sensor are made on a stacked feature matrix
+    with the classifier's predict_features.
+
+    A query that cannot be served (e.g., an unknown sensor, an invalid time, or a
+    window whose features cannot be extracted) gets an error result, and the other
+    queries are still predicted.
+
+    With streaming enabled, features of queries for the latest readings are taken
+    from sliding feature windows that are updated as readings arrive (see
+    db_manager.latest_features_for_inputs) instead of being recomputed from the
+    whole sampling period. This is meant for continuous predictions on every tick.
+
+    Args:
+        queries: An array of dictionaries
+            [
+                {
+                    'sensor_id': An object ID of a virtual sensor
+                    'time': A unix timestamp used as the end time. When omitted,
+                        the latest readings are used.
+                },
+                { more queries }
+            ]
+        user_id: A user ID of a user who own the virtual sensors
+        streaming: True to use streaming features for the latest readings when
+            the classifier supports them
+
+    Returns:
+        An array of MLClassifierResult instances in the order of queries
+    '''
+    results = [MLClassifierResult() for query in queries]
+    sensors = {}
+    classifiers = {}
+
+    # Load each virtual sensor and its classifier once
+    for query, clf_result in zip(queries, results):
+        sensor_id = query.get('sensor_id')
+        if not isinstance(sensor_id, basestring):
+            clf_result.result = 'error'
+            clf_result.message = 'A sensor ID is required.'
+            continue
+
+        if sensor_id not in classifiers:
+            try:
+                sensors[sensor_id] = db_manager.sensor(sensor_id, user_id)
+                classifiers[sensor_id] = db_manager.classifier(sensor_id, user_id)
+            except (IndexError, InvalidId, TypeError):
+                sensors[sensor_id] = None
+                classifiers[sensor_id] = None
+
+        if sensors[sensor_id] is None:
+            clf_result.result = 'error'
+            clf_result.message = 'The sensor not found.'
+        elif classifiers[sensor_id] is None or not classifiers[sensor_id].is_trained():
+            clf_result.result = 'error'
+            clf_result.message = 'A classifier for the sensor not found.'
+
+    # Fetch timeseries data for all valid queries
+    timeseries = [None] * len(queries)
+    features = [None] * len(queries)
+    windows = []
+    window_indexes = []
+    latest = {}
+    for idx, query in enumerate(queries):
+        if results[idx].result == 'error':
+            continue
+
+        sensor_id = query['sensor_id']
+        sensor = sensors[sensor_id]
+        classifier = classifiers[sensor_id]
+
+        if query.get('time') is not None:
+            end_time = parse_time(query['time'])
+            if end_time is None:
+                results[idx].result = 'error'
+                results[idx].message = 'The time must be a unix timestamp.'
+                continue
+
+            windows.append((sensor.inputs, end_time-classifier.sampling_period, end_time))
+            window_indexes.append(idx)
+        elif streaming and classifier.STREAMING_FEATURES:
+            if sensor_id not in latest:
+                latest[sensor_id] = db_manager.latest_features_for_inputs(sensor.inputs, classifier.sampling_period)
+            if latest[sensor_id] is not None:
+                features[idx] = latest[sensor_id]
+            else:
+                # Recent readings are not available, so query the sampling period
+                timeseries[idx] = db_manager.latest_timeseries_for_inputs(sensor.inputs, classifier.sampling_period)
+        else:
+            if sensor_id not in latest:
+                latest[sensor_id] = db_manager.latest_timeseries_for_inputs(sensor.inputs, classifier.sampling_period)
+            timeseries[idx] = latest[sensor_id]
+
+    for idx, window_data in zip(window_indexes, db_manager.timeseries_for_queries(windows)):
+        timeseries[idx] = window_data
+
+    # Make predictions for each virtual sensor on stacked features
+    by_sensor = {}
+    for idx, query in enumerate(queries):
+        if results[idx].result != 'error':
+            by_sensor.setdefault(query['sensor_id'], []).append(idx)
+
+    for sensor_id, indexes in by_sensor.items():
+        classifier = classifiers[sensor_id]
+
+        # A window whose features cannot be extracted only fails its own query
+        valid = []
+        rows = []
+        with metrics.stage('preprocess'):
+            for idx in indexes:
+                try:
+                    row = features[idx] if features[idx] is not None else classifier.preprocess(timeseries[idx])
+                    row = np.asarray(row, dtype='float').ravel()
+                    if len(row) == 0 or not np.all(np.isfinite(row)):
+                        raise ValueError('no readings in the window')
+                except Exception as e:
+                    results[idx].result = 'error'
+                    results[idx].message = 'Could not extract features: %s' % e
+                    continue
+
+                valid.append(idx)
+                rows.append(row)
+
+        if len(valid) == 0:
+            continue
+
+        try:
+            predictions = classifier.predict_features(np.vstack(rows))
+        except Exception:
+            # Rows of different lengths cannot be stacked, so predict each row
+            predictions = []
+            for idx, row in zip(valid, rows):
+                try:
+                    predictions.append(classifier.predict_features(row.reshape(1, -1))[0])
+                except Exception as e:
+                    results[idx].result = 'error'
+                    results[idx].message = 'A classification error occurred: %s' % e
+                    predictions.append(None)
+
+        for idx, prediction in zip(valid, predictions):
+            results[idx].prediction = prediction
+
+    return results
+
+def parse_time(value):
+    '''Returns a unix timestamp given in a query as a float, or None if invalid'''
+    try:
+        end_time = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    if not np.isfinite(end_time):
+        return None
+
+    return end_time
+
 if __name__=="__main__":
     # code for a quick test
     result = train('56d39911a9705e0c2b966d6a','default')
@@ -1,16 +1,35 @@
-'''Randome Forest Classifer Module'''
+'''Randome Forest Classifer Module
 
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.cross_validation import cross_val_score
-from sklearn import preprocessing
-from sklearn import feature_selection
+sklearn takes a noticeable time to import, so it is imported when a forest is
+trained. Predictions use compiled forests and do not need it.
+'''
 
+import time
 import pickle
 import numpy as np
+from bson.binary import Binary
 
 from giotto.ml.database.classifier import MLClassifier
 from giotto.ml.database.sensor import MLSensor  
+from giotto.ml.classifier.compiled_forest import CompiledForest
+from giotto.helper import metrics
 
+# The number of cores used to fit a forest. -1 uses all cores.
+FIT_JOBS = -1
+
+# Incremental training keeps the stored forest and replaces its oldest trees with
+# INCREMENTAL_TREE_FRACTION of new trees fitted on the updated training set. It is
+# used while no sample was removed and samples added since the last full training
+# run are at most INCREMENTAL_MAX_NEW_FRACTION of the training set. Set
+# INCREMENTAL_MAX_NEW_FRACTION to 0 to always fit a new forest.
+INCREMENTAL_MAX_NEW_FRACTION = 0.1
+INCREMENTAL_TREE_FRACTION = 0.2
+
+def new_forest(**parameters):
+    '''Returns a new RandomForestClassifier with given parameters'''
+    from sklearn.ensemble import RandomForestClassifier
+
+    return RandomForestClassifier(**parameters)
 
 class MLRandomForest(MLClassifier):
     '''Random Forest classifier class
@@ -20,38 +39,84 @@ class MLRandomForest(MLClassifier):
     the "predict" function. 
     If you want to implement a classifier class using other models, replicate
     this class. The class have to implement two functions at least, train and predict.
+
+    A trained forest is also compiled into packed node arrays (see CompiledForest),
+    which make predictions instead of the forest and are stored next to it. A
+    serialized dictionary may hold only the compiled forest in 'compiled'.
+
+    Retraining after a few new samples grows the stored forest instead of
+    fitting a new one (see INCREMENTAL_MAX_NEW_FRACTION). 'training' keeps the
+    samples that the forest was trained on to make this decision.
     '''
+    STREAMING_FEATURES = True
+
     def __init__(self, dictionary=None, serialized=False):
         MLClassifier.__init__(self, dictionary, serialized)
-        if self.model is None:
-            self.model = RandomForestClassifier()
+        self.compiled = None
+        self.training = None
+        if dictionary is not None:
+            self.training = dictionary.get('training')
+        if serialized and dictionary is not None and dictionary.get('compiled') is not None:
+            self.compiled = CompiledForest.loads(dictionary['compiled'])
+        elif self.classifier is not None:
+            # Stored before forests were compiled
+            self.compiled = CompiledForest.compile(self.classifier, self.scaler)
+
+        # The forest itself is created when it is first trained
+        if dictionary is None:
             self.model_name = 'random forest'
 
+    def is_trained(self):
+        '''Returns True if this classifier can make predictions'''
+        return self.compiled is not None or self.classifier is not None
+
+    def to_dictionary(self, serialized=False):
+        '''Creates a dictionary that contains all properties
+
+        When serialized=True, the compiled forest is added as 'compiled' with its
+        size in 'compiled_bytes' (see MLClassifier.to_dictionary). 'training'
+        describes the last training run (see train).
+        '''
+        dic = MLClassifier.to_dictionary(self, serialized)
+        dic['training'] = self.training
+        if serialized and self.compiled is not None:
+            compiled = self.compiled.dumps()
+            dic['compiled'] = Binary(compiled)
+            dic['compiled_bytes'] = len(compiled)
+
+        return dic
+
     def extract_features(self, dataset):
         '''Extracts features from a given dataset
 
         Extracts features with the preprocess function. The function is implemented
-        in the MLClassifier class.
+        in the MLClassifier class. Samples that already have features (e.g., loaded
+        from the feature store) are not preprocessed again. Extracted features are
+        set to the samples so that they can be stored.
         '''
         data = dataset['data']
         labels = dataset['labels']
 
-        all_features = []
-        all_labels = []
+        # Map a label to its index once instead of searching the label list per sample
+        label_index = dict((label, idx) for idx, label in enumerate(labels))
 
-        for sample in data:
-            raw_data = sample['timeseries']
+        all_features = None
+        all_labels = np.zeros(len(data), dtype='int')
 
-            features = self.preprocess(raw_data)
-            indexed_label = labels.index(sample['label'])
+        for row, sample in enumerate(data):
+            features = sample.get('features')
+            if features is None:
+                with metrics.stage('preprocess'):
+                    features = self.preprocess(sample['timeseries'])
+                sample['features'] = features
 
-            # Stack features and labels
-            if all_features == []:
-                all_features = features
-            else:
-                all_features = np.vstack((all_features,features))
+            # Allocate the feature matrix once the number of features is known,
+            # and fill it in place
+            if all_features is None:
+                all_features = np.zeros((len(data), len(features)))
+            all_features[row] = features
 
-            all_labels.append(indexed_label)
+            all_labels[row] = label_index[sample['label']]
 
         data = {
             'features':all_features,
@@ -61,14 +126,56 @@ class MLRandomForest(MLClassifier):
 
         return data            
 
+    def tune(self, dataset):
+        '''Chooses parameters of the forest with a cross-validated search
+
+        See giotto.ml.classifier.tuning for the searched parameters and the budget.
+        Later training runs keep the chosen parameters, since the model is stored
+        with the classifier.
+        '''
+        from giotto.ml.classifier import tuning
+
+        data = self.extract_features(dataset)
+        report = tuning.search(data['features'], data['labels'])
+        if report is not None:
+            # The same seed as the search, so that the stored forest is the
+            # candidate that was cross-validated and measured
+            self.model = new_forest(random_state=tuning.RANDOM_STATE, **report['parameters'])
+            self.tuning = report
+
+        return report
+
     def train(self, dataset):
-        '''Trains a random forest classifier'''
+        '''Trains a random forest classifier
+
+        Fits a new forest, or grows the stored forest when only a few samples
+        were added since the last full training run (see can_train_incrementally).
+        Growing the forest fits INCREMENTAL_TREE_FRACTION of its trees on the
+        updated training set and drops as many of the oldest trees, so its cost
+        does not depend on the number of trees. The scaler of the stored forest
+        is kept, since its trees split on features scaled by it.
+
+        'training' is set to a dictionary that describes the training run
+            {
+                'mode': 'full' or 'incremental'
+                'samples': The number of samples in the training set
+                'last_sample_id': The largest object ID of the samples
+                'full_samples': The number of samples at the last full training run
+                'replaced_trees': The number of trees replaced by an incremental run
+                'fit_time': Seconds spent fitting trees
+            }
+        '''
+
+        from sklearn import preprocessing
 
         # Generate a training set
         data = self.extract_features(dataset)
+        sample_ids = [sample['sample_id'] for sample in dataset['data'] if 'sample_id' in sample]
+        incremental = self.can_train_incrementally(dataset, data, sample_ids)
 
         # Prescale
-        self.scaler = preprocessing.StandardScaler().fit(data['features'])
+        if not incremental:
+            self.scaler = preprocessing.StandardScaler().fit(data['features'])
         scaledFeatures = self.scaler.transform(data['features'])
 
         # Select features  Random Forest does not require feature selection
@@ -77,26 +184,142 @@ class MLRandomForest(MLClassifier):
         #selectedFeatures = self.selector.transform(scaledFeatures)
 
         # Train a classifier
-        self.classifier = self.model.fit(scaledFeatures, data['labels'])
+        replaced = 0
+        started = time.time()
+        with metrics.stage('classifier_fit'):
+            if incremental:
+                replaced = self.grow_forest(scaledFeatures, data['labels'])
+            else:
+                if self.model is None:
+                    self.model = new_forest()
+                self.model.set_params(n_jobs=FIT_JOBS, warm_start=False)
+                self.classifier = self.model.fit(scaledFeatures, data['labels'])
+        fit_time = time.time() - started
+
+        self.compiled = CompiledForest.compile(self.classifier, self.scaler)
         self.sampling_period = data['sampling_period']
         self.labels = dataset['labels']
+        self.training = {
+            'mode': 'incremental' if incremental else 'full',
+            'samples': len(dataset['data']),
+            'last_sample_id': max(sample_ids) if len(sample_ids) > 0 else None,
+            'full_samples': self.training['full_samples'] if incremental else len(dataset['data']),
+            'replaced_trees': replaced,
+            'fit_time': fit_time
+        }
+
+    def can_train_incrementally(self, dataset, data, sample_ids):
+        '''Checks if the stored forest can be grown on a training set
+
+        Args:
+            dataset: A training set passed to train
+            data: Features extracted from the training set by extract_features
+            sample_ids: Object IDs of the samples in the training set
+
+        Returns:
+            True if the stored forest was trained on the same labels and features,
+            no sample was removed since then, and samples added since the last
+            full training run are at most INCREMENTAL_MAX_NEW_FRACTION of the set
+        '''
+        if self.training is None or self.classifier is None or self.scaler is None:
+            return False
+
+        # A tuned or new model replaces the stored forest
+        if self.model is not self.classifier or not hasattr(self.classifier, 'estimators_'):
+            return False
+
+        if dataset['labels'] != self.labels or len(sample_ids) != len(dataset['data']):
+            return False
+
+        if len(np.unique(data['labels'])) != len(self.classifier.classes_):
+            return False
+
+        if data['features'].shape[1] != self.classifier.estimators_[0].tree_.n_features:
+            return False
+
+        # Object IDs increase with insertion, so samples of the last training run
+        # are those up to its last sample. All of them must remain.
+        last_sample_id = self.training.get('last_sample_id')
+        if last_sample_id is None:
+            return False
+        kept = len([sample_id for sample_id in sample_ids if sample_id <= last_sample_id])
+        if kept != self.training['samples']:
+            return False
+
+        added = len(sample_ids) - self.training['full_samples']
+
+        return added <= INCREMENTAL_MAX_NEW_FRACTION * len(sample_ids)
+
+    def grow_forest(self, features, labels):
+        '''Replaces the oldest trees of the stored forest with trees fitted on a training set
+
+        Args:
+            features: Scaled features of the training set
+            labels: Label indexes of the training set
+
+        Returns:
+            The number of replaced trees
+        '''
+        forest = self.classifier
+        size = len(forest.estimators_)
+        replaced = max(1, int(round(size * INCREMENTAL_TREE_FRACTION)))
+
+        # warm_start appends new trees to estimators_
+        forest.set_params(n_jobs=FIT_JOBS, warm_start=True, n_estimators=size + replaced)
+        forest.fit(features, labels)
+        forest.estimators_ = forest.estimators_[replaced:]
+        forest.set_params(warm_start=False, n_estimators=size)
+
+        return replaced
 
     def predict(self, timeseries):
         '''Makes a prediction using a pre-trained random forest classifier'''
 
-        features = self.preprocess(timeseries)
+        with metrics.stage('preprocess'):
+            features = self.preprocess(timeseries)
         features = features.reshape(1, -1)
 
-        # prescaling
-        scaled_features = self.scaler.transform(features)
+        return self.predict_features(features)[0]
+
+    def predict_batch(self, timeseries_list):
+        '''Makes predictions for multiple timeseries data at once
+
+        Features of all timeseries data are stacked into one matrix, which is
+        scaled and classified with a single call each.
+        '''
+        if len(timeseries_list) == 0:
+            return []
+
+        features = None
+        with metrics.stage('preprocess'):
+            for row, timeseries in enumerate(timeseries_list):
+                row_features = self.preprocess(timeseries)
+                if features is None:
+                    features = np.zeros((len(timeseries_list), len(row_features)))
+                features[row] = row_features
+
+        return self.predict_features(features)
+
+    def predict_features(self, features):
+        '''Makes predictions for rows of extracted features'''
+
+        if self.compiled is not None:
+            with metrics.stage('classifier_predict'):
+                predictions = self.compiled.predict(features)
+
+            return [self.labels[int(prediction)] for prediction in predictions]
+
+        with metrics.stage('classifier_predict'):
+            # prescaling
+            scaled_features = self.scaler.transform(features)
 
-        # Feture selection
-        #selectedFeatures = selector.transform(scaledFeatures)
+            # Feture selection
+            #selectedFeatures = selector.transform(scaledFeatures)
 
-        # Prediction
-        predictions = self.classifier.predict(scaled_features)
+            # Prediction
+            predictions = self.classifier.predict(scaled_features)
 
-        return self.labels[predictions[0].astype(int)]
+        return [self.labels[prediction.astype(int)] for prediction in predictions]
 
 if __name__=="__main__":
     clf = MLRandomForest('56b3c0f023cf8c29e049e89e','default')
@@ -0,0 +1,255 @@
+'''Incremental sliding-window features for streaming inference
+
+Computes the same features as MLClassifier.preprocess over a sliding time window,
+but updates them as readings enter and leave the window instead of recomputing
+them from scratch. The cost of an update depends on the number of new readings,
+not on the length of the window.
+
+    - mean and standard deviation: Welford's algorithm with removal
+    - minimum and maximum: monotonic deques
+    - zero-crossings: counted on the pairs of readings at the edges of the window
+    - peaks: local extrema are flagged at the edges of the window, and their values
+      are kept in an order-statistic structure to count those above 2 * std
+    - median: an order-statistic structure of all values in the window
+'''
+import math
+import bisect
+from collections import deque
+
+import numpy as np
+
+class SortedValues:
+    '''A sorted multiset of numbers with order-statistic queries
+
+    Values are kept in sorted blocks of bounded size, so adding and removing a
+    value and rank queries take O(sqrt(n)) time.
+    '''
+    BLOCK_SIZE = 256
+
+    def __init__(self):
+        self.blocks = []
+        self.maxes = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value):
+        '''Adds a value'''
+        if len(self.blocks) == 0:
+            self.blocks.append([value])
+            self.maxes.append(value)
+            self.size = 1
+            return
+
+        idx = bisect.bisect_left(self.maxes, value)
+        if idx == len(self.blocks):
+            idx -= 1
+
+        block = self.blocks[idx]
+        bisect.insort(block, value)
+        self.maxes[idx] = block[-1]
+        self.size += 1
+
+        # Split a block that grew too large
+        if len(block) > 2 * self.BLOCK_SIZE:
+            self.blocks[idx:idx+1] = [block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:]]
+            self.maxes[idx:idx+1] = [self.blocks[idx][-1], self.blocks[idx+1][-1]]
+
+    def remove(self, value):
+        '''Removes one occurrence of a value. The value must exist.'''
+        idx = bisect.bisect_left(self.maxes, value)
+        block = self.blocks[idx]
+        del block[bisect.bisect_left(block, value)]
+        self.size -= 1
+
+        if len(block) == 0:
+            del self.blocks[idx]
+            del self.maxes[idx]
+        else:
+            self.maxes[idx] = block[-1]
+
+    def kth(self, k):
+        '''Returns the k-th smallest value (0-based)'''
+        for block in self.blocks:
+            if k < len(block):
+                return block[k]
+            k -= len(block)
+
+        raise IndexError('k is out of range')
+
+    def median(self):
+        '''Returns the median, averaging the two middle values for an even count'''
+        half = self.size // 2
+        if self.size % 2 == 1:
+            return self.kth(half)
+
+        return (self.kth(half - 1) + self.kth(half)) / 2.0
+
+    def count_greater(self, threshold):
+        '''Returns the number of values strictly greater than threshold'''
+        idx = bisect.bisect_right(self.maxes, threshold)
+        if idx == len(self.blocks):
+            return 0
+
+        block = self.blocks[idx]
+        count = len(block) - bisect.bisect_right(block, threshold)
+        for block in self.blocks[idx+1:]:
+            count += len(block)
+
+        return count
+
+class MLSlidingWindowFeatures:
+    '''Running features of one channel over a sliding time window
+
+    The window holds readings whose timestamps are within the last seconds of
+    the newest reading (both ends inclusive). features() returns the eight
+    features of MLClassifier.preprocess for the readings in the window.
+    '''
+    # Mean and variance are recomputed from the window after this many updates
+    # to bound the rounding errors of the running updates
+    RESYNC_INTERVAL = 10000
+
+    def __init__(self, seconds):
+        '''Initializes an empty window
+
+        Args:
+            seconds: A length of the window in seconds
+        '''
+        self.seconds = seconds
+        # Readings as [sequence number, timestamp, value, local extremum flag]
+        self.window = deque()
+        self.sequence = 0
+
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.updates = 0
+
+        self.min_deque = deque()    # (sequence number, value), values increasing
+        self.max_deque = deque()    # (sequence number, value), values decreasing
+        self.values = SortedValues()
+        self.extrema = SortedValues()
+        self.zero_crossings = 0
+
+    def __len__(self):
+        return len(self.window)
+
+    def extend(self, timestamps, values):
+        '''Adds readings in timestamp order
+
+        Readings that are not newer than the newest reading in the window are ignored.
+        '''
+        for timestamp, value in zip(timestamps, values):
+            self.add(timestamp, value)
+
+    def add(self, timestamp, value):
+        '''Adds a reading and drops readings that fall out of the window'''
+        timestamp = float(timestamp)
+        value = float(value)
+        if len(self.window) > 0 and timestamp <= self.window[-1][1]:
+            return
+
+        # The previous reading gets its right neighbor, so check if it is a local extremum
+        if len(self.window) >= 2:
+            prev = self.window[-1]
+            prev2 = self.window[-2]
+            if (prev[2] - prev2[2]) * (value - prev[2]) < 0:
+                prev[3] = True
+                self.extrema.add(prev[2])
+
+        if len(self.window) >= 1 and self.window[-1][2] * value < 0:
+            self.zero_crossings += 1
+
+        self.window.append([self.sequence, timestamp, value, False])
+        self.values.add(value)
+        self.add_to_moments(value)
+
+        while len(self.min_deque) > 0 and self.min_deque[-1][1] >= value:
+            self.min_deque.pop()
+        self.min_deque.append((self.sequence, value))
+        while len(self.max_deque) > 0 and self.max_deque[-1][1] <= value:
+            self.max_deque.pop()
+        self.max_deque.append((self.sequence, value))
+
+        self.sequence += 1
+
+        while self.window[0][1] < timestamp - self.seconds:
+            self.remove_oldest()
+
+        self.updates += 1
+        if self.updates >= self.RESYNC_INTERVAL:
+            self.resync()
+
+    def remove_oldest(self):
+        '''Removes the oldest reading from the window'''
+        sequence, timestamp, value, extremum = self.window.popleft()
+
+        if len(self.window) > 0:
+            first = self.window[0]
+            if value * first[2] < 0:
+                self.zero_crossings -= 1
+
+            # The new oldest reading loses its left neighbor
+            if first[3]:
+                first[3] = False
+                self.extrema.remove(first[2])
+
+        self.values.remove(value)
+        self.remove_from_moments(value)
+
+        if self.min_deque[0][0] == sequence:
+            self.min_deque.popleft()
+        if self.max_deque[0][0] == sequence:
+            self.max_deque.popleft()
+
+    def add_to_moments(self, value):
+        '''Adds a value to the running mean and sum of squared deviations'''
+        count = len(self.window)
+        delta = value - self.mean
+        self.mean += delta / count
+        self.m2 += delta * (value - self.mean)
+
+    def remove_from_moments(self, value):
+        '''Removes a value from the running mean and sum of squared deviations'''
+        count = len(self.window)
+        if count == 0:
+            self.mean = 0.0
+            self.m2 = 0.0
+            return
+
+        delta = value - self.mean
+        self.mean -= delta / count
+        self.m2 = max(0.0, self.m2 - delta * (value - self.mean))
+
+    def resync(self):
+        '''Recomputes the mean and sum of squared deviations from the window'''
+        values = np.array([reading[2] for reading in self.window])
+        self.mean = float(np.mean(values))
+        self.m2 = float(np.sum((values - self.mean) ** 2))
+        self.updates = 0
+
+    def features(self):
+        '''Returns features of the readings in the window
+
+        Returns:
+            A ndarray of average, standard deviation, number of peaks, median,
+            minimum, maximum, number of zero-crossings, and max - min, or None
+            if the window is empty
+        '''
+        if len(self.window) == 0:
+            return None
+
+        std = math.sqrt(self.m2 / len(self.window))
+        minimum = self.min_deque[0][1]
+        maximum = self.max_deque[0][1]
+
+        return np.array([
+            self.mean,
+            std,
+            self.extrema.count_greater(std * 2),
+            self.values.median(),
+            minimum,
+            maximum,
+            self.zero_crossings,
+            maximum - minimum
+        ])
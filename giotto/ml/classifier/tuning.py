@@ -0,0 +1,302 @@
+'''Cross-validated hyperparameter search for random forest classifiers
+
+Evaluates combinations of n_estimators, max_depth, and min_samples_leaf with
+k-fold cross-validation. Fitting forests is CPU-bound, so candidates are
+evaluated in parallel on a pool of worker processes. Each candidate is also
+fitted on the whole training set and compiled (see CompiledForest). The latency
+of a single-row prediction is measured afterwards in the calling process, one
+candidate at a time, so that it does not include contention with the parallel
+fits. The most accurate candidate within a latency and model size budget is
+chosen.
+
+Searches run from training threads of a server that also runs other threads,
+and forking a process while another thread holds a lock can deadlock the child.
+So the worker processes of a search are never forked from the calling process.
+They are started with the forkserver (or spawn) method where it is available.
+Otherwise (e.g., on Python 2), a helper process is started with a fresh
+interpreter (python -m giotto.ml.classifier.tuning), and the helper, which runs
+no other threads, forks the workers. Workers only exist while a search runs.
+'''
+import os
+import sys
+import time
+import timeit
+import pickle
+import itertools
+import subprocess
+import multiprocessing
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import StratifiedKFold, cross_val_score
+
+from giotto.ml.classifier.compiled_forest import CompiledForest
+
+# Values of RandomForestClassifier parameters searched by search
+PARAMETER_GRID = {
+    'n_estimators': [10, 30, 100],
+    'max_depth': [None, 6, 12],
+    'min_samples_leaf': [1, 3, 10]
+}
+
+# The number of cross-validation folds. Fewer folds are used when a label has
+# fewer samples than this.
+TUNING_FOLDS = 5
+
+# The budget of a chosen model: seconds of a single-row prediction and bytes of
+# the compiled forest. None disables a limit.
+MAX_LATENCY = 0.002
+MAX_MODEL_BYTES = 1024*1024
+
+# The number of worker processes. None uses all CPUs.
+TUNING_PROCESSES = None
+
+# The number of single-row predictions timed per candidate
+LATENCY_ROWS = 20
+
+# A fixed seed so that all candidates are compared on the same random draws
+RANDOM_STATE = 0
+
+# The root directory of the giotto package, added to the path of a helper process
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..')
+
+def pool_context():
+    '''Returns a multiprocessing context that does not fork the calling process,
+    or None where only fork is available'''
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        return None
+
+    for method in ('forkserver', 'spawn'):
+        if method in multiprocessing.get_all_start_methods():
+            return get_context(method)
+
+    return None
+
+def evaluate_on_pool(tasks, processes, context=multiprocessing):
+    '''Evaluates tasks on a pool of worker processes that only lives for the call
+
+    Args:
+        tasks: An array of tasks for evaluate
+        processes: The number of worker processes
+        context: A multiprocessing context that starts the workers. The default
+            forks, so only use it in a process without other threads.
+
+    Returns:
+        An array of results of evaluate in the order of tasks
+    '''
+    pool = context.Pool(processes)
+    try:
+        return pool.map(evaluate, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def evaluate_in_helper(tasks, processes):
+    '''Evaluates tasks on worker processes forked by a helper process
+
+    The helper is a fresh interpreter running main, so forking there is safe.
+
+    Returns:
+        An array of results of evaluate in the order of tasks
+
+    Raises:
+        RuntimeError: The helper process failed
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+
+    helper = subprocess.Popen([sys.executable, '-m', 'giotto.ml.classifier.tuning'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    output, _ = helper.communicate(pickle.dumps((tasks, processes), pickle.HIGHEST_PROTOCOL))
+    if helper.returncode != 0:
+        raise RuntimeError('The tuning helper process exited with %d' % helper.returncode)
+
+    return pickle.loads(output)
+
+def candidates(grid):
+    '''Returns all combinations of parameter values in a grid
+
+    Args:
+        grid: A dictionary {parameter name: an array of values}
+
+    Returns:
+        An array of dictionaries {parameter name: value}
+    '''
+    names = sorted(grid.keys())
+
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def evaluate(task):
+    '''Cross-validates one candidate and measures its compiled model
+
+    Runs in a worker process, so it takes a single picklable tuple.
+
+    Args:
+        task: (parameters, features, labels, folds)
+
+    Returns:
+        A dictionary that describes the candidate (see search)
+    '''
+    parameters, features, labels, folds = task
+    model = RandomForestClassifier(random_state=RANDOM_STATE, **parameters)
+
+    started = timeit.default_timer()
+    scores = cross_val_score(model, features, labels, cv=StratifiedKFold(n_splits=folds))
+    cv_time = timeit.default_timer() - started
+
+    started = timeit.default_timer()
+    model.fit(features, labels)
+    fit_time = timeit.default_timer() - started
+
+    compiled = CompiledForest.compile(model)
+    compiled_bytes = compiled.dumps()
+
+    return {
+        'parameters': parameters,
+        'accuracy': float(np.mean(scores)),
+        'accuracy_std': float(np.std(scores)),
+        'cv_time': cv_time,
+        'fit_time': fit_time,
+        'model_bytes': len(compiled_bytes),
+        'nodes': int(len(compiled.left)),
+        'compiled': compiled_bytes
+    }
+
+def measure_latency(compiled, features):
+    '''Returns the median seconds of a single-row prediction of a compiled forest'''
+    latencies = []
+    for row in features[:LATENCY_ROWS]:
+        started = timeit.default_timer()
+        compiled.predict(row.reshape(1, -1))
+        latencies.append(timeit.default_timer() - started)
+
+    return float(np.median(latencies))
+
+def within_budget(candidate, max_latency, max_model_bytes):
+    '''Returns True if a candidate evaluated by evaluate fits a budget'''
+    if max_latency is not None and candidate['latency'] > max_latency:
+        return False
+    if max_model_bytes is not None and candidate['model_bytes'] > max_model_bytes:
+        return False
+
+    return True
+
+def search(features, labels, grid=None, folds=None, max_latency=MAX_LATENCY,
+           max_model_bytes=MAX_MODEL_BYTES, processes=None):
+    '''Searches random forest parameters with k-fold cross-validation
+
+    The candidate with the highest mean accuracy among those within the budget is
+    chosen, and the faster one wins a tie. When no candidate fits the budget, the
+    fastest candidate is chosen.
+
+    Args:
+        features: A two-dimensional ndarray with one row of features per sample
+        labels: An ndarray of label indexes of the samples
+        grid: Parameter values to search (see PARAMETER_GRID)
+        folds: The number of cross-validation folds (see TUNING_FOLDS)
+        max_latency: Seconds allowed for a single-row prediction, or None
+        max_model_bytes: Bytes allowed for a compiled forest, or None
+        processes: The number of worker processes (see TUNING_PROCESSES). 1 runs
+            the search in the calling process.
+
+    Returns:
+        A report of the search, or None if a label has less than two samples
+            {
+                'parameters': Parameters of the chosen candidate
+                'accuracy': The mean cross-validated accuracy of the chosen candidate
+                'within_budget': True if the chosen candidate fits the budget
+                'folds': The number of folds used
+                'budget': {'max_latency': seconds, 'max_model_bytes': bytes}
+                'processes': The number of worker processes used, or 1 if the
+                    search ran in the calling process
+                'duration': Seconds spent on the search
+                'candidates': [
+                    {
+                        'parameters': RandomForestClassifier parameters
+                        'accuracy': The mean accuracy over folds
+                        'accuracy_std': The standard deviation of accuracy over folds
+                        'cv_time': Seconds spent on cross-validation
+                        'fit_time': Seconds to fit the whole training set
+                        'latency': The median seconds of a single-row prediction,
+                            measured in the calling process
+                        'model_bytes': Bytes of the compiled forest
+                        'nodes': The number of nodes of all trees
+                        'within_budget': True if the candidate fits the budget
+                    },
+                    { more candidates }
+                ]
+            }
+    '''
+    if grid is None:
+        grid = PARAMETER_GRID
+    if folds is None:
+        folds = TUNING_FOLDS
+
+    # Stratified folds need at least one sample of every label in each fold
+    counts = np.bincount(labels)
+    folds = int(min(folds, counts[counts > 0].min()))
+    if folds < 2:
+        return None
+
+    tasks = [(parameters, features, labels, folds) for parameters in candidates(grid)]
+    if processes is None:
+        processes = TUNING_PROCESSES or multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+
+    started = time.time()
+    results = None
+    if processes > 1:
+        try:
+            if pool_context() is not None:
+                results = evaluate_on_pool(tasks, processes, pool_context())
+            else:
+                results = evaluate_in_helper(tasks, processes)
+        except (OSError, RuntimeError) as e:
+            print('Could not evaluate candidates in parallel: %s' % e)
+    if results is None:
+        results = [evaluate(task) for task in tasks]
+        processes = 1
+
+    # Fits ran in parallel on all cores, so time predictions here one at a time
+    for result in results:
+        compiled = CompiledForest.loads(result.pop('compiled'))
+        result['latency'] = measure_latency(compiled, features)
+        result['within_budget'] = within_budget(result, max_latency, max_model_bytes)
+
+    eligible = [result for result in results if result['within_budget']]
+    if len(eligible) > 0:
+        chosen = max(eligible, key=lambda result: (result['accuracy'], -result['latency']))
+    else:
+        chosen = min(results, key=lambda result: result['latency'])
+
+    return {
+        'parameters': chosen['parameters'],
+        'accuracy': chosen['accuracy'],
+        'within_budget': chosen['within_budget'],
+        'folds': folds,
+        'budget': {
+            'max_latency': max_latency,
+            'max_model_bytes': max_model_bytes
+        },
+        'processes': processes,
+        'duration': time.time() - started,
+        'candidates': results
+    }
+
+def main():
+    '''Runs a helper process for evaluate_in_helper
+
+    Reads pickled (tasks, processes) from stdin, and writes pickled results to
+    stdout. Anything printed goes to stderr, so that it does not mix with them.
+    '''
+    tasks, processes = pickle.load(getattr(sys.stdin, 'buffer', sys.stdin))
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    sys.stdout = sys.stderr
+
+    results = evaluate_on_pool(tasks, processes)
+    pickle.dump(results, output, pickle.HIGHEST_PROTOCOL)
+    output.flush()
+
+if __name__ == '__main__':
+    main()
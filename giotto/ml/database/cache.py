@@ -0,0 +1,126 @@
+"""An in-process LRU cache for deserialized classifiers
+
+Loading a classifier from MongoDB unpickles the classifier, scaler, model, and
+selector on every call. The cache keeps recently used classifiers in memory
+so that predictions can skip loading and unpickling the model.
+
+Invalidation only reaches the cache of the process that invalidates. Callers
+that share classifiers with other processes check that a cached classifier is
+still current (see giotto.ml.database.manager.classifier).
+"""
+import threading
+from collections import OrderedDict
+
+class MLClassifierCache:
+    '''A bounded, thread-safe LRU cache of MLClassifier instances
+
+    Entries are keyed by (user_id, sensor_id). When the cache is full, the least
+    recently used entry is evicted. Hit, miss, and eviction counters are kept to
+    help size the cache.
+
+    Each key has a generation that is bumped when the key is invalidated. A
+    loader takes the generation before reading a classifier from the database
+    and passes it to put, so that a classifier read before an invalidation is
+    not cached after it.
+    '''
+    def __init__(self, capacity=128):
+        '''Initializes an empty cache
+
+        Args:
+            capacity: The maximum number of classifiers held in the cache.
+                0 disables caching.
+        '''
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sensor_id, user_id):
+        '''Returns a cached classifier, or None if it is not cached'''
+        key = (user_id, sensor_id)
+        with self.lock:
+            clf = self.entries.pop(key, None)
+            if clf is None:
+                self.misses += 1
+                return None
+
+            # Re-insert to mark the entry as the most recently used one
+            self.entries[key] = clf
+            self.hits += 1
+            return clf
+
+    def generation(self, sensor_id, user_id):
+        '''Returns the generation of a virtual sensor's key (see put)'''
+        with self.lock:
+            return self.generations.get((user_id, sensor_id), 0)
+
+    def put(self, clf, generation=None):
+        '''Adds a classifier to the cache, evicting the oldest entry if necessary
+
+        Args:
+            clf: A MLClassifier instance
+            generation: The generation returned by generation before the classifier
+                was read. The classifier is not cached if the key was invalidated
+                since then. None always caches it.
+        '''
+        if self.capacity <= 0:
+            return
+
+        key = (clf.user_id, clf.sensor_id)
+        with self.lock:
+            if generation is not None and self.generations.get(key, 0) != generation:
+                return
+
+            self.entries.pop(key, None)
+            self.entries[key] = clf
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, sensor_id, user_id):
+        '''Removes a classifier of a virtual sensor from the cache'''
+        key = (user_id, sensor_id)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def invalidate_object(self, object_id):
+        '''Removes a classifier with a given object ID from the cache'''
+        object_id = str(object_id)
+        with self.lock:
+            for key, clf in list(self.entries.items()):
+                if clf.object_id == object_id:
+                    del self.entries[key]
+                    self.generations[key] = self.generations.get(key, 0) + 1
+
+    def clear(self):
+        '''Removes all classifiers from the cache'''
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        '''Returns a dictionary of cache counters
+
+        Returns:
+            {
+                'capacity': The maximum number of entries
+                'size': The current number of entries
+                'hits': The number of lookups served from the cache
+                'misses': The number of lookups not found in the cache
+                'evictions': The number of entries evicted because the cache was full
+                'hit_rate': hits / (hits + misses), or 0 if there was no lookup
+            }
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'capacity': self.capacity,
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups > 0 else 0.0
+            }
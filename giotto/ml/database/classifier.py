@@ -1,9 +1,27 @@
 import json
+import zlib
 import pickle
 import numpy as np
+from bson.binary import Binary
+
+# A version of the storage format written by to_dictionary(serialized=True)
+#   1: classifier, scaler, model, and selector pickled separately
+#   2: one compressed pickle ('blob') that stores a shared model only once
+STORAGE_FORMAT = 2
 
 class MLClassifier:
     '''Classifier base class'''
+
+    # A version of the feature extraction in preprocess. Features stored in the
+    # feature store are reused only for the same version, so increment this value
+    # when preprocess changes (including overrides in derived classes).
+    FEATURE_VERSION = 1
+
+    # True if a derived class implements predict_features and uses the features of
+    # this preprocess, which can then be computed incrementally on a sliding window
+    # (see giotto.ml.classifier.streaming)
+    STREAMING_FEATURES = False
+
     def __init__(self, dictionary=None, serialized=False):
         '''Initializes an instance
 
@@ -28,7 +46,15 @@ class MLClassifier:
                     'classifier': A trained random forest classifier
                     'scaler': A scaler that scales inputs as a part of pre-processing
                     'selector': A feature selector
+                    'tuning': A report of a hyperparameter search, or None
+                        (see tune)
+                    'revision': A string that changes every time the classifier
+                        is stored, or None
                 }
+                A serialized dictionary in the current storage format holds 'blob'
+                instead of classifier, scaler, model, and selector
+                (see to_dictionary). A serialized dictionary without any of them
+                (e.g., loaded for predictions only) leaves them None.
 
         Returns: A MLClassifier instance
         '''
@@ -44,6 +70,8 @@ class MLClassifier:
             self.selector = None
             self.labels = []
             self.sampling_period = 0
+            self.tuning = None
+            self.revision = None
         else:
             self.object_id = str(dictionary['_id'])
             self.sensor_id = dictionary['sensor_id']
@@ -51,12 +79,21 @@ class MLClassifier:
             self.model_name = dictionary['model_name']
             self.labels = dictionary['labels']
             self.sampling_period = dictionary['sampling_period']
+            self.tuning = dictionary.get('tuning')
+            self.revision = dictionary.get('revision')
 
-            if serialized:
+            if serialized and 'blob' in dictionary:
+                self.load_blob(dictionary['blob'])
+            elif serialized and 'classifier' in dictionary:
                 self.classifier = pickle.loads(dictionary['classifier'])
                 self.scaler = pickle.loads(dictionary['scaler'])
                 self.model = pickle.loads(dictionary['model'])
                 self.selector = pickle.loads(dictionary['selector'])
+            elif serialized:
+                self.classifier = None
+                self.scaler = None
+                self.model = None
+                self.selector = None
             else:
                 self.classifier = dictionary['classifier']
                 self.scaler = dictionary['scaler']
@@ -68,7 +105,10 @@ class MLClassifier:
 
         Creates a dictionary that contains all properties to store a classifier
         in a database. When serialized=True, classifier, scaler, selector, and
-        model instance are serialized.
+        model instance are serialized into one compressed blob. The model is
+        usually the same object as the classifier (model.fit returns itself), so
+        it is stored only once. Metadata such as labels and sampling_period stays
+        outside of the blob and can be read without loading it.
 
         Args:
             serialized: A flag that indicates if instances should be serialized or not
@@ -83,14 +123,16 @@ class MLClassifier:
             'user_id': self.user_id,
             'model_name': self.model_name,
             'sampling_period': self.sampling_period,
-            'labels': self.labels
+            'labels': self.labels,
+            'tuning': self.tuning
         }
 
         if serialized:
-            dic['classifier'] = pickle.dumps(self.classifier)
-            dic['scaler'] = pickle.dumps(self.scaler)
-            dic['selector'] = pickle.dumps(self.selector)
-            dic['model'] = pickle.dumps(self.model)
+            blob, raw_bytes = self.dump_blob()
+            dic['format'] = STORAGE_FORMAT
+            dic['blob'] = Binary(blob)
+            dic['raw_bytes'] = raw_bytes
+            dic['stored_bytes'] = len(blob)
         else:
             dic['classifier'] = self.classifier
             dic['scaler'] = self.scaler
@@ -99,6 +141,36 @@ class MLClassifier:
 
         return dic
 
+    def dump_blob(self):
+        '''Serializes classifier, scaler, model, and selector into one compressed blob
+
+        Returns:
+            (blob, raw_bytes): A zlib-compressed pickle and its uncompressed size
+        '''
+        bundle = {
+            'classifier': self.classifier,
+            'scaler': self.scaler,
+            'selector': self.selector
+        }
+        if self.model is not self.classifier:
+            bundle['model'] = self.model
+
+        raw = pickle.dumps(bundle, pickle.HIGHEST_PROTOCOL)
+
+        return zlib.compress(raw), len(raw)
+
+    def load_blob(self, blob):
+        '''Loads classifier, scaler, model, and selector from a blob made by dump_blob'''
+        bundle = pickle.loads(zlib.decompress(blob))
+        self.classifier = bundle['classifier']
+        self.scaler = bundle['scaler']
+        self.selector = bundle['selector']
+        self.model = bundle.get('model', self.classifier)
+
+    def is_trained(self):
+        '''Returns True if this classifier can make predictions'''
+        return self.classifier is not None
+
     def train(self, dataset):
         '''Trains a classifier using the dataset as a training set
 
@@ -112,6 +184,9 @@ class MLClassifier:
                          [
                             {
                                 'timeseries': An array of timeseries data arrays
+                                'features': Features extracted in a previous
+                                    training run, or None. When given, timeseries
+                                    is None and preprocess is skipped.
                                 'label': A string label for the timeseries data
                             },
                             { more samples }
@@ -125,6 +200,21 @@ class MLClassifier:
         '''
         pass
 
+    def tune(self, dataset):
+        '''Chooses hyperparameters of the model for a training set
+
+        A derived class can implement a search here. It should replace model
+        with one that has the chosen parameters, so that train fits it, and
+        keep a report of the search in tuning.
+
+        Args:
+            dataset: A dictionary that holds a training set (see train)
+
+        Returns:
+            A report of the search, or None if no search was made
+        '''
+        pass
+
     def predict(self, timeseries):
         '''Makes a prediction using a pre-trained classifier
 
@@ -138,6 +228,34 @@ class MLClassifier:
         '''
         pass
 
+    def predict_batch(self, timeseries_list):
+        '''Makes predictions for multiple timeseries data
+
+        A derived class can override this function to make all predictions at once.
+
+        Args:
+            timeseries_list: An array of timeseries data, each of which is passed
+                to predict
+
+        Returns:
+            labels: an array of string labels in the order of timeseries_list
+        '''
+        return [self.predict(timeseries) for timeseries in timeseries_list]
+
+    def predict_features(self, features):
+        '''Makes predictions for features that are already extracted
+
+        A derived class should implement this function to support predictions on
+        features computed outside of preprocess, e.g., by streaming feature windows.
+
+        Args:
+            features: A two-dimensional ndarray with one row of features per prediction
+
+        Returns:
+            labels: an array of string labels in the order of rows
+        '''
+        pass
+
     def to_json(self):
         '''Returns a JSON representation of a MLClassifier instance'''
         return json.dumps(self, default=lambda o: o.__dict__, separators=(',',':'))
@@ -148,6 +266,8 @@ class MLClassifier:
         Extracts the following features from a array of timeseries data.
         Averages, standard deviations, numbers of peaks, medians, minimum values,
         maximum values, numbers of zero-crossing, differences between max and min.
+        All channels are stacked into one matrix (see stack_readings) and every
+        feature is computed for all channels at once with array operations.
         If you want to implement your own feature extraction, overwrite this function
         in a derived class.
 
@@ -157,57 +277,113 @@ class MLClassifier:
         Returns:
             f: a ndarray that contains features for each timeseries data 
         '''
-        colNum = len(sensor_readings)
+        readings, ragged = stack_readings(sensor_readings)
+        colNum = readings.shape[0]
         features = np.zeros((colNum,8))
 
-        for col in range(0,colNum):
+        # Channels with different lengths are padded with NaN, so NaN-aware
+        # reductions are only needed when the lengths actually differ
+        if ragged:
+            average, std, median = np.nanmean, np.nanstd, np.nanmedian
+            minimum, maximum = np.nanmin, np.nanmax
+        else:
+            average, std, median = np.mean, np.std, np.median
+            minimum, maximum = np.min, np.max
+
+        # average
+        features[:,0] = average(readings, axis=1)
+
+        # std
+        features[:,1] = std(readings, axis=1)
 
-            vals = np.array(sensor_readings[col]).astype('float')
-            # average
-            features[col,0] = np.average(vals)
-            
-            # std
-            features[col,1] = np.std(vals)
-            
-            # peak count
-            features[col,2] = self.peak_count(vals)
+        # peak count
+        features[:,2] = self.peak_count(readings, features[:,1])
 
-            # median
-            features[col,3] = np.median(vals)
+        # median
+        features[:,3] = median(readings, axis=1)
 
-            # min
-            features[col,4] = np.min(vals)
+        # min
+        features[:,4] = minimum(readings, axis=1)
 
-            # max
-            features[col,5] = np.max(vals)
+        # max
+        features[:,5] = maximum(readings, axis=1)
 
-            # zero crossing
-            features[col,6] = self.zero_crossing(vals)
+        # zero crossing
+        features[:,6] = self.zero_crossing(readings)
 
-            # max - min
-            features[col,7] = features[col-1,5] - features[col-1,4]
+        # max - min
+        features[:,7] = features[:,5] - features[:,4]
 
         f = features.reshape(1,colNum*8)[0]
 
         return f
 
     def zero_crossing(self, data):
-        '''Counts the number of zero-crossing in given timesries data'''
-        count = 0
-        for idx in range(len(data)-1):
-            if data[idx]*data[idx+1] < 0:
-                count = count + 1
+        '''Counts the number of zero-crossing in given timesries data
+
+        Args:
+            data: A one-dimensional array of readings, or a two-dimensional array
+                with one channel per row
+
+        Returns:
+            The number of zero-crossings, or an array of counts (one per row)
+        '''
+        data = np.asarray(data, dtype='float')
+        with np.errstate(invalid='ignore'):
+            crossings = data[...,:-1] * data[...,1:] < 0
+
+        return np.sum(crossings, axis=-1)
+
+    def peak_count(self, data, std=None):
+        '''Counts the number of peaks in given timesries data
+
+        A peak is a local extremum whose value is larger than twice the
+        standard deviation of the data.
+
+        Args:
+            data: A one-dimensional array of readings, or a two-dimensional array
+                with one channel per row
+            std: Standard deviations of the data (one per row). Computed from
+                data when omitted.
+
+        Returns:
+            The number of peaks, or an array of counts (one per row)
+        '''
+        data = np.asarray(data, dtype='float')
+        if std is None:
+            std = np.nanstd(data, axis=-1)
+        std = np.asarray(std, dtype='float')[...,np.newaxis]
+
+        slopes = np.diff(data, axis=-1)
+        with np.errstate(invalid='ignore'):
+            peaks = (data[...,1:-1] > std*2) & (slopes[...,:-1] * slopes[...,1:] < 0)
+
+        return np.sum(peaks, axis=-1)
+
+
+def stack_readings(sensor_readings):
+    '''Stacks timeseries data from multiple channels into one matrix
 
-        return count
+    Real sensors have different sampling rates, so the channels may have
+    different lengths. Shorter channels are padded with NaN at the end.
+    Comparisons with NaN are always False, so padded cells never count as
+    peaks or zero-crossings.
 
-    def peak_count(self, data):
-        '''Counts the number of peaks in given timesries data'''
-        count = 0
-        std = np.std(data)
-        for idx in range(len(data)-2):
-            if data[idx+1] > std*2 and (data[idx+1] - data[idx]) * (data[idx+2] - data[idx+1]) < 0:
-                count = count + 1
+    Args:
+        sensor_readings: An array of timeseries data arrays
 
-        return count
+    Returns:
+        (readings, ragged): A float ndarray with one channel per row and a flag
+            that is True when the channels have different lengths
+    '''
+    lengths = [len(channel) for channel in sensor_readings]
+    if len(set(lengths)) <= 1:
+        readings = np.array(sensor_readings, dtype='float')
+        return readings.reshape(len(lengths), -1), False
 
+    readings = np.empty((len(lengths), max(lengths)))
+    readings.fill(np.nan)
+    for row, channel in enumerate(sensor_readings):
+        readings[row,:lengths[row]] = channel
 
+    return readings, True
@@ -4,25 +4,223 @@ Handles database manipulattion related to the machine learning layer.
 Timeseries data is stored in InfluxDB and other data is stored in MongoDB. 
 """ 
 
+import os
 import sys
+import getpass
 import pickle
+import tempfile
 import json
+import bisect
 import pymongo
 import time
 import datetime
+import threading
+from multiprocessing.pool import ThreadPool
 from pymongo import MongoClient
-from influxdb import InfluxDBClient
+from pymongo.errors import BulkWriteError
 
+import gridfs
+from gridfs.errors import NoFile
+import numpy as np
 from bson.objectid import ObjectId
 from giotto.ml.database.sensor import MLSensor
-from giotto.ml.database.sample import MLSample
+from giotto.ml.database.sample import MLSample, validate_sample
 from giotto.ml.database.classifier import MLClassifier
+from giotto.ml.database.cache import MLClassifierCache
+from giotto.ml.database.timeseries_cache import MLTimeseriesCache
+from giotto.ml.database.stream import MLStreamIngestor
 from giotto.ml.classifier.random_forest import MLRandomForest
 from giotto.helper.buildingdepot_helper import BuildingDepotHelper
+from giotto.helper import metrics
 
-mongo_client = MongoClient().machine_learning
-influx_client = InfluxDBClient('localhost', 8086, 'root', 'root', 'buildingdepot')
-buildingdepot_helper = BuildingDepotHelper('../../config/buildingdepot_setting.json')
+# A path to the BuildingDepot setting file. The GIOTTO_BUILDINGDEPOT_SETTING
+# environment variable overrides it (e.g., to point benchmarks at a local server).
+BUILDINGDEPOT_SETTING_PATH = os.environ.get('GIOTTO_BUILDINGDEPOT_SETTING',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../config/buildingdepot_setting.json'))
+
+# Clients of MongoDB, InfluxDB, and BuildingDepot are created on first use by
+# the accessor functions below (mongo_database, model_files, influx, and
+# buildingdepot), so importing this module does not connect to any server.
+# The local timeseries cache and the stream ingestor are created the same way
+# (see timeseries_cache and stream_ingestor).
+clients = {}
+clients_lock = threading.RLock()
+
+def shared_client(name, factory):
+    '''Returns a client shared by all threads, creating it with factory() on first use'''
+    client = clients.get(name)
+    if client is not None:
+        return client
+
+    with clients_lock:
+        if name not in clients:
+            clients[name] = factory()
+
+        return clients[name]
+
+def mongo_database():
+    '''Returns the machine_learning database of MongoDB
+
+    The indexes in INDEXES are created when the database is first used.
+    '''
+    def connect():
+        database = MongoClient().machine_learning
+        ensure_indexes(database)
+        return database
+
+    return shared_client('mongo', connect)
+
+def model_files():
+    '''Returns the GridFS bucket that holds large serialized classifiers'''
+    return shared_client('model_files', lambda: gridfs.GridFS(mongo_database(), 'models'))
+
+def influx():
+    '''Returns an InfluxDB client'''
+    def connect():
+        from influxdb import InfluxDBClient
+        return InfluxDBClient('localhost', 8086, 'root', 'root', 'buildingdepot')
+
+    return shared_client('influx', connect)
+
+def buildingdepot():
+    '''Returns a BuildingDepotHelper'''
+    return shared_client('buildingdepot', lambda: BuildingDepotHelper(BUILDINGDEPOT_SETTING_PATH))
+
+# The maximum number of deserialized classifiers kept in memory for predictions
+CLASSIFIER_CACHE_SIZE = 128
+classifier_cache = MLClassifierCache(CLASSIFIER_CACHE_SIZE)
+
+# The default maximum number of BuildingDepot requests issued in parallel by
+# timeseries_for_inputs. Keep it at or below the HTTP pool size of the helper
+# so that every request gets a pooled connection.
+TIMESERIES_FETCH_CONCURRENCY = 8
+
+# A projection that skips the serialized model fields of classifier documents
+# (the legacy pickles, the current blob, and the compiled forest) for
+# metadata-only reads
+CLASSIFIER_METADATA_PROJECTION = {
+    'classifier':False,
+    'scaler':False,
+    'model':False,
+    'selector':False,
+    'blob':False,
+    'compiled':False
+}
+
+# A projection that loads a classifier for predictions, which only need the
+# compiled forest (see MLRandomForest)
+CLASSIFIER_COMPILED_PROJECTION = {
+    'classifier':False,
+    'scaler':False,
+    'model':False,
+    'selector':False,
+    'blob':False,
+    'blob_id':False
+}
+
+# Serialized model fields of classifier documents that are moved to GridFS when
+# they are large. A moved field is replaced by its file ID in '<field>_id'.
+MODEL_FILE_FIELDS = ['blob', 'compiled']
+
+# Serialized classifiers larger than this many bytes are stored in GridFS instead
+# of inline, to stay well below MongoDB's 16 MB document limit
+CLASSIFIER_INLINE_LIMIT = 4*1024*1024
+
+# Sample windows separated by at most this many seconds are loaded with a single
+# BuildingDepot query when a training set is built
+TIMESERIES_MERGE_GAP = 0
+
+# Default values used when the "timeseries_cache" section of the BuildingDepot
+# setting file omits them
+DEFAULT_TIMESERIES_CACHE_SETTING = {
+    'enabled': True,            # False always fetches timeseries data from BuildingDepot
+    'directory': None,          # A private directory for the cache, or None for a per-user temporary one
+    'max_bytes': 512*1024*1024  # The maximum total size of cached data
+}
+
+def timeseries_cache():
+    '''Returns the local cache of historical timeseries data, or None if it is disabled
+
+    The cache is opened on first use with the "timeseries_cache" section of the
+    BuildingDepot setting file (see DEFAULT_TIMESERIES_CACHE_SETTING). A directory
+    that other users can access disables the cache.
+    '''
+    def open_cache():
+        setting = dict(DEFAULT_TIMESERIES_CACHE_SETTING)
+        try:
+            with open(BUILDINGDEPOT_SETTING_PATH, 'r') as f:
+                setting.update(json.load(f).get('timeseries_cache', {}))
+        except (IOError, ValueError):
+            pass
+
+        if not setting['enabled']:
+            return None
+
+        directory = setting['directory']
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'giotto_timeseries_cache_' + getpass.getuser())
+
+        try:
+            return MLTimeseriesCache(directory, setting['max_bytes'])
+        except OSError as e:
+            print('The timeseries cache is disabled: %s' % e)
+            return None
+
+    return shared_client('timeseries_cache', open_cache)
+
+# Recent readings of real sensors used by "latest" predictions are kept in memory.
+# Tracked sensors are polled every STREAM_POLL_INTERVAL seconds.
+STREAM_POLL_INTERVAL = 1.0
+
+def fetch_recent_timeseries(queries):
+    '''Fetches (uuid, start_time, end_time) queries from BuildingDepot in parallel'''
+    def fetch(query):
+        with metrics.stage('buildingdepot_poll'):
+            return buildingdepot().get_timeseries(*query)
+
+    return map_concurrently(fetch, queries)
+
+def stream_ingestor():
+    '''Returns the MLStreamIngestor that keeps recent readings for "latest" predictions'''
+    return shared_client('stream_ingestor', lambda: MLStreamIngestor(fetch_recent_timeseries, STREAM_POLL_INTERVAL))
+
+# The number of documents fetched per round trip by iterate_sensors and iterate_samples
+CURSOR_BATCH_SIZE = 500
+
+# The number of samples written per insert_many call by insert_samples
+SAMPLE_INSERT_CHUNK_SIZE = 1000
+
+# Compound indexes that serve the lookups in this module. Each entry is
+# (collection name, keys). The trailing _id keeps results of a user's or
+# a sensor's documents in insertion order without sorting.
+INDEXES = [
+    ('sensors', [('user_id', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]),
+    ('samples', [('user_id', pymongo.ASCENDING), ('sensor_id', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]),
+    ('classifiers', [('user_id', pymongo.ASCENDING), ('sensor_id', pymongo.ASCENDING)]),
+    ('features', [('user_id', pymongo.ASCENDING), ('sensor_id', pymongo.ASCENDING), ('feature_key', pymongo.ASCENDING)]),
+    ('features', [('sample_id', pymongo.ASCENDING)])
+]
+
+def ensure_indexes(database=None):
+    '''Creates the indexes in INDEXES if they do not exist
+
+    Creating an existing index is a no-op, so this function is called every time
+    a process first uses the database (see mongo_database).
+
+    Args:
+        database: A MongoDB database, or None to use mongo_database()
+
+    Returns:
+        An array of index names
+    '''
+    if database is None:
+        database = mongo_database()
+
+    names = []
+    for collection, keys in INDEXES:
+        names.append(database[collection].create_index(keys, background=True))
+
+    return names
 
 def insert_sensor(sensor):
     '''Inserts a sensor entry to MongoDB
@@ -34,7 +232,7 @@ def insert_sensor(sensor):
         An object ID of the inserted sensor entry or None if insertion failed.
     '''
     dic = sensor.to_dictionary()
-    result = mongo_client.sensors.insert_one(dic)
+    result = mongo_database().sensors.insert_one(dic)
     
     return str(result.inserted_id)
 
@@ -47,7 +245,7 @@ def update_sensor(sensor):
     Returns:
         An object ID of the updated sensor entry
     ''' 
-    col = mongo_client.sensors
+    col = mongo_database().sensors
     dic = sensor.to_dictionary()
     del dic['_id']
     result = col.update_one({'_id':ObjectId(sensor._id)}, {'$set':dic})
@@ -61,7 +259,7 @@ def delete_sensor(sensor_id, user_id):
         sensor_id: An object ID of a sensor to be deleted
         user_id: A user ID of a user who perform this manipulation
     '''
-    mongo_client.sensors.delete_one({'_id':ObjectId(sensor_id)})
+    mongo_database().sensors.delete_one({'_id':ObjectId(sensor_id)})
 
 def sensor(sensor_id, user_id):
     '''Get sensor informaiton
@@ -74,13 +272,22 @@ def sensor(sensor_id, user_id):
         sensor: A MLSensor instance or None if there is no sensor with
             a given sensor_id        
     '''
-    result = mongo_client.sensors.find({'_id':ObjectId(sensor_id)})
+    result = mongo_database().sensors.find({'_id':ObjectId(sensor_id)})
     if result.count != 0:
         sensor = MLSensor(result[0])
         return sensor
     else:
         return None
 
+def sensor_exists(sensor_id, user_id):
+    '''Returns True if a user owns a sensor, without loading the sensor
+
+    Args:
+        sensor_id: An object ID of a sensor
+        user_id: A user ID of a user who perform this operation
+    '''
+    return mongo_database().sensors.find_one({'_id':ObjectId(sensor_id), 'user_id':user_id}, {'_id':True}) is not None
+
 def sensors(user_id):
     '''Get a list of sensors that a user owns
 
@@ -90,7 +297,7 @@ def sensors(user_id):
     Retuens:
         An array of MLSensor instances
     '''
-    result = mongo_client.sensors.find({'user_id':user_id})
+    result = mongo_database().sensors.find({'user_id':user_id})
     sensors = []
     for row in result:
         sensor = MLSensor(row)
@@ -98,6 +305,48 @@ def sensors(user_id):
 
     return sensors
 
+def iterate_sensors(user_id, after=None, limit=None):
+    '''Iterates over sensors that a user owns in the order of their object IDs
+
+    Documents are read from a MongoDB cursor in batches of CURSOR_BATCH_SIZE, so
+    memory use does not depend on the number of sensors.
+
+    Args:
+        user_id: A user ID of a user.
+        after: An object ID of a sensor. Only sensors after it are returned.
+        limit: The maximum number of sensors, or None for no limit
+
+    Returns:
+        An iterator of MLSensor instances
+
+    Raises:
+        bson.errors.InvalidId: after is not a valid object ID
+    '''
+    return iterate_documents(mongo_database().sensors, {'user_id':user_id}, after, limit, MLSensor)
+
+def iterate_documents(collection, condition, after, limit, cls):
+    '''Iterates over documents matching a condition in the order of their object IDs
+
+    Args:
+        collection: A MongoDB collection
+        condition: A query condition
+        after: An object ID. Only documents after it are returned.
+        limit: The maximum number of documents, or None for no limit
+        cls: A class that is initialized with a document
+
+    Returns:
+        An iterator of cls instances
+    '''
+    condition = dict(condition)
+    if after is not None:
+        condition['_id'] = {'$gt':ObjectId(after)}
+
+    cursor = collection.find(condition).sort('_id', pymongo.ASCENDING).batch_size(CURSOR_BATCH_SIZE)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+
+    return (cls(row) for row in cursor)
+
 def insert_sample(sensor_id, user_id, start_time, end_time, label):
     '''Inserts a training sample
 
@@ -121,10 +370,107 @@ def insert_sample(sensor_id, user_id, start_time, end_time, label):
         'end_time':end_time,
         'label':label
     }
-    result = mongo_client.samples.insert_one(sample)
+    result = mongo_database().samples.insert_one(sample)
 
     return str(result.inserted_id)
 
+def insert_samples(sensor_id, user_id, samples, ordered=True, chunk_size=None):
+    '''Inserts many training samples with bulk writes
+
+    Samples are validated (see validate_sample) and written with insert_many in
+    chunks of chunk_size, so a large upload takes a few round trips and samples
+    can be consumed from a stream.
+
+    With ordered=True, samples are inserted in order and processing stops at the
+    first invalid sample or write error. Later samples are reported as not
+    inserted. With ordered=False, every valid sample is attempted.
+
+    Args:
+        sensor_id: An object ID of a virtual sensor related to the samples
+        user_id: A user ID of a user who perform this manipulation
+        samples: An iterable of dictionaries with 'start_time', 'end_time', and
+            'label'. Items that are not dictionaries are reported as invalid.
+        ordered: A flag that indicates if processing stops at the first error
+        chunk_size: The number of samples per insert_many call.
+            SAMPLE_INSERT_CHUNK_SIZE is used when omitted.
+
+    Returns:
+        An array of dictionaries in the order of samples
+            [
+                {
+                    'sample_id': An object ID of an inserted sample, or None
+                    'error': An error message, or None if the sample was inserted
+                },
+                { more results }
+            ]
+    '''
+    if chunk_size is None:
+        chunk_size = SAMPLE_INSERT_CHUNK_SIZE
+
+    results = []
+    chunk = []      # (index in results, document)
+    stopped = False
+
+    def flush():
+        '''Writes the pending chunk and returns True if a write error occurred'''
+        if len(chunk) == 0:
+            return False
+
+        docs = [doc for idx, doc in chunk]
+        errors = {}
+        try:
+            mongo_database().samples.insert_many(docs, ordered=ordered)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                errors[error['index']] = error.get('errmsg', 'A write error occurred.')
+
+        # insert_many sets _id of each document before writing it
+        failed = False
+        for position, (idx, doc) in enumerate(chunk):
+            if position in errors:
+                results[idx]['error'] = errors[position]
+                failed = True
+            elif ordered and failed:
+                results[idx]['error'] = SAMPLE_NOT_INSERTED
+            else:
+                results[idx]['sample_id'] = str(doc['_id'])
+
+        del chunk[:]
+        return failed
+
+    for item in samples:
+        results.append({'sample_id':None, 'error':None})
+        if stopped:
+            results[-1]['error'] = SAMPLE_NOT_INSERTED
+            continue
+
+        error = validate_sample(item)
+        if error is not None:
+            if ordered:
+                # Samples before the invalid one are still inserted
+                flush()
+                stopped = True
+            results[-1]['error'] = error
+            continue
+
+        chunk.append((len(results) - 1, {
+            'sensor_id':sensor_id,
+            'user_id':user_id,
+            'start_time':item['start_time'],
+            'end_time':item['end_time'],
+            'label':item['label']
+        }))
+        if len(chunk) >= chunk_size:
+            stopped = flush() and ordered
+
+    if not stopped:
+        flush()
+
+    return results
+
+# A message for samples skipped by an ordered insert_samples after an error
+SAMPLE_NOT_INSERTED = 'Not inserted because an earlier sample failed.'
+
 def delete_sample(sensor_id, user_id, sample_id):
     '''Deletes a sample
 
@@ -141,7 +487,8 @@ def delete_sample(sensor_id, user_id, sample_id):
         'sensor_id':sensor_id,
         'user_id':user_id
     }
-    result = mongo_client.sensors.delete_one(condition)
+    result = mongo_database().sensors.delete_one(condition)
+    mongo_database().features.delete_many({'sample_id':sample_id, 'user_id':user_id})
 
     return result.deleted_count
 
@@ -161,7 +508,8 @@ def delete_all_samples(sensor_id, user_id):
         'sensor_id':sensor_id,
         'user_id':user_id
     }
-    result = mongo_client.sensors.delete_many(condition)
+    result = mongo_database().sensors.delete_many(condition)
+    mongo_database().features.delete_many(condition)
 
     return result.deleted_count
 
@@ -178,7 +526,7 @@ def samples(sensor_id, user_id):
         An array consisting of MLSample instances
     '''
 
-    result = mongo_client.samples.find({'user_id':user_id, 'sensor_id':sensor_id})
+    result = mongo_database().samples.find({'user_id':user_id, 'sensor_id':sensor_id})
     samples = []
     for row in result:
         sample = MLSample(row)
@@ -186,6 +534,28 @@ def samples(sensor_id, user_id):
 
     return samples
 
+def iterate_samples(sensor_id, user_id, after=None, limit=None):
+    '''Iterates over samples of a virtual sensor in the order of their object IDs
+
+    Documents are read from a MongoDB cursor in batches of CURSOR_BATCH_SIZE, so
+    memory use does not depend on the number of samples.
+
+    Args:
+        sensor_id: An object ID of a virtual sensor
+        user_id: A user ID of a user who perform this
+        after: An object ID of a sample. Only samples after it are returned.
+        limit: The maximum number of samples, or None for no limit
+
+    Returns:
+        An iterator of MLSample instances
+
+    Raises:
+        bson.errors.InvalidId: after is not a valid object ID
+    '''
+    condition = {'user_id':user_id, 'sensor_id':sensor_id}
+
+    return iterate_documents(mongo_database().samples, condition, after, limit, MLSample)
+
 def sample(sample_id, user_id):
     '''Gets a sample
 
@@ -198,7 +568,7 @@ def sample(sample_id, user_id):
     Returns:
         A MLSample instance or None if a sample with specified object ID not found
     '''
-    result = mongo_client.samples.find({'_id':ObjectId(sample_id)})
+    result = mongo_database().samples.find({'_id':ObjectId(sample_id)})
     if result.count != 0:
         sample = MLSample(result[0])
         return sample
@@ -225,6 +595,9 @@ def store_classifier(classifier):
     else:
         object_id = update_classifier(classifier)
 
+    # A cached copy is stale now. It will be reloaded on the next lookup
+    classifier_cache.invalidate(classifier.sensor_id, classifier.user_id)
+
     return object_id
 
 def insert_classifier(classifier):
@@ -236,8 +609,8 @@ def insert_classifier(classifier):
     Returns:
         An object ID of an inserted entry, or None if the operation fails
     '''
-    clf = classifier.to_dictionary(True)
-    result = mongo_client.classifiers.insert_one(clf)
+    clf = classifier_document(classifier)
+    result = mongo_database().classifiers.insert_one(clf)
 
     return str(result.inserted_id)
 
@@ -255,15 +628,73 @@ def update_classifier(classifier):
         return None
 
     object_id = ObjectId(classifier.object_id) 
-    updated_doc = mongo_client.classifiers.update({'_id':object_id}, classifier.to_dictionary(serialized=True))
+    old_doc = mongo_database().classifiers.find_one({'_id':object_id}, model_file_projection())
+    result = mongo_database().classifiers.replace_one({'_id':object_id}, classifier_document(classifier))
 
-    if updated_doc is None or updated_doc['err'] is not None:
+    if result.matched_count == 0:
         return None
-    else:
-        return object_id
 
+    # Remove a replaced model from GridFS
+    delete_model_files(old_doc)
+
+    return object_id
+
+def classifier_document(classifier):
+    '''Returns a MongoDB document that stores a classifier
+
+    The classifier is serialized into a compressed blob (see MLClassifier.to_dictionary).
+    A blob or compiled forest larger than CLASSIFIER_INLINE_LIMIT is stored in
+    GridFS and the document only holds its file ID as 'blob_id' or 'compiled_id'.
+
+    Every document gets a new 'revision', which tells other processes that
+    cached a previous version of the classifier that it was replaced (see
+    classifier).
+
+    Args:
+        classifier: A MLClassifier instance
+
+    Returns:
+        A dictionary to be stored in the classifiers collection
+    '''
+    doc = classifier.to_dictionary(serialized=True)
+    doc['revision'] = str(ObjectId())
+    for field in MODEL_FILE_FIELDS:
+        if field in doc and len(doc[field]) > CLASSIFIER_INLINE_LIMIT:
+            doc[field + '_id'] = model_files().put(doc[field], sensor_id=classifier.sensor_id, user_id=classifier.user_id)
+            del doc[field]
+
+    return doc
+
+def model_file_projection():
+    '''Returns a projection that only loads GridFS file IDs of a classifier document'''
+    return dict((field + '_id', True) for field in MODEL_FILE_FIELDS)
+
+def read_model_files(doc):
+    '''Reads model fields stored in GridFS back into a classifier document
+
+    Returns:
+        True if all files were read, or False if a file was deleted because the
+        classifier was replaced after the document was read
+    '''
+    for field in MODEL_FILE_FIELDS:
+        if doc.get(field + '_id') is not None:
+            try:
+                doc[field] = model_files().get(doc[field + '_id']).read()
+            except NoFile:
+                return False
+
+    return True
 
-def classifier(sensor_id, user_id, model='random forest'):
+def delete_model_files(doc):
+    '''Deletes GridFS files referenced by a classifier document, which may be None'''
+    if doc is None:
+        return
+
+    for field in MODEL_FILE_FIELDS:
+        if doc.get(field + '_id') is not None:
+            model_files().delete(doc[field + '_id'])
+
+def classifier(sensor_id, user_id, model='random forest', cached=True, compiled=True):
     '''Gets a classifier
 
     Gets a classifier instance related to a specified virtual sensor. If no classifier
@@ -271,19 +702,51 @@ def classifier(sensor_id, user_id, model='random forest'):
     This implementation use random forest. If you want to add other classifiers
     with other models, modify code in this function.
 
+    Stored classifiers are kept in classifier_cache after they are loaded, so that
+    following calls skip loading and unpickling the model. A cached instance is
+    shared, so callers that modify the classifier (e.g., training) should pass
+    cached=False. store_classifier and delete_classifier only invalidate the cache
+    of their own process, and a classifier may be stored by another process (e.g.,
+    the REST API trains classifiers that the prediction scheduler caches). So each
+    cache hit is checked against the revision of the stored document, which is
+    read without the model fields.
+
+    With compiled=True, only the compiled forest of a classifier is loaded when it
+    has one, and the pickled forest is left in the database. Such an instance makes
+    predictions but cannot be trained further or stored again.
+
     Args:
         sensor_id: An object ID of a virtual sensor
         user_id: A user ID of a user who perform this operation
         model: A name of a machine learning model used for this classifier
+        cached: A flag that indicates if classifier_cache can be used
+        compiled: A flag that indicates if only the compiled forest is loaded
 
     Returns:
         MLClassifier (or its delived class) instance
     '''
-    result = mongo_client.classifiers.find({'user_id':user_id, 'sensor_id':sensor_id})
-
-    if result.count() > 0:
-        dic = result[0]
-        clf = MLRandomForest(dic, serialized=True)
+    if cached:
+        clf = classifier_cache.get(sensor_id, user_id)
+        if clf is not None:
+            stored = mongo_database().classifiers.find_one({'user_id':user_id, 'sensor_id':sensor_id}, {'revision':True})
+            if stored is not None and stored.get('revision') == clf.revision:
+                return clf
+
+            # Replaced or deleted by another process
+            classifier_cache.invalidate(sensor_id, user_id)
+
+        # Taken before the read, so that a classifier replaced during the read
+        # is not cached (see MLClassifierCache.put)
+        generation = classifier_cache.generation(sensor_id, user_id)
+
+    with metrics.stage('classifier_load'):
+        dic = classifier_document_with_files({'user_id':user_id, 'sensor_id':sensor_id}, compiled)
+
+    if dic is not None:
+        with metrics.stage('classifier_unpickle'):
+            clf = MLRandomForest(dic, serialized=True)
+        if cached:
+            classifier_cache.put(clf, generation)
     else:
         clf = MLRandomForest()
         clf.sensor_id = sensor_id
@@ -291,12 +754,84 @@ def classifier(sensor_id, user_id, model='random forest'):
 
     return clf
 
+def classifier_document_with_files(condition, compiled):
+    '''Reads a classifier document and its GridFS files
+
+    update_classifier deletes the files of a replaced classifier, so a document
+    read just before a replacement may reference deleted files. Then, the
+    document is read once more to get the files of the new classifier.
+
+    Args:
+        condition: A MongoDB query that matches the classifier document
+        compiled: A flag that indicates if only the compiled forest is loaded
+            (see classifier)
+
+    Returns:
+        A classifier document with model fields, or None if it is not found
+    '''
+    for attempt in range(2):
+        dic = None
+        if compiled:
+            dic = mongo_database().classifiers.find_one(condition, CLASSIFIER_COMPILED_PROJECTION)
+            if dic is not None and dic.get('compiled') is None and dic.get('compiled_id') is None:
+                # Stored before forests were compiled, so load the pickled forest
+                dic = None
+        if dic is None:
+            dic = mongo_database().classifiers.find_one(condition)
+        if dic is None or read_model_files(dic):
+            return dic
+
+    raise NoFile('Model files of a classifier were deleted while it was loaded')
+
+def classifier_metadata(sensor_id, user_id):
+    '''Gets metadata of a classifier without loading the serialized model
+
+    Args:
+        sensor_id: An object ID of a virtual sensor
+        user_id: A user ID of a user who perform this operation
+
+    Returns:
+        A dictionary with '_id', 'sensor_id', 'user_id', 'model_name', 'labels',
+        'sampling_period', 'format', 'raw_bytes', and 'stored_bytes' (when stored in
+        the current format), and 'compiled_bytes' (when the forest is compiled),
+        or None if the virtual sensor has no classifier
+    '''
+    return mongo_database().classifiers.find_one({'user_id':user_id, 'sensor_id':sensor_id}, CLASSIFIER_METADATA_PROJECTION)
+
+def classifiers_metadata(user_id):
+    '''Gets metadata of all classifiers of a user without loading serialized models
+
+    Args:
+        user_id: A user ID of a user who perform this operation
+
+    Returns:
+        An array of dictionaries in the format of classifier_metadata
+    '''
+    return list(mongo_database().classifiers.find({'user_id':user_id}, CLASSIFIER_METADATA_PROJECTION))
+
 def delete_classifier(classifier, user_id):
-    '''Delets a classifier'''
+    '''Delets a classifier
 
-    result = mongo_client.classifier.remove({'_id':ObjectId(classifier)})
+    Args:
+        classifier: An object ID of a classifier
+        user_id: A user ID of a user who perform this operation
+
+    Returns:
+        1 if deletion was successful, or 0 otherwise
+    '''
+    projection = model_file_projection()
+    projection.update({'sensor_id':True, 'user_id':True})
+    doc = mongo_database().classifiers.find_one({'_id':ObjectId(classifier)}, projection)
+    result = mongo_database().classifiers.delete_one({'_id':ObjectId(classifier)})
+    classifier_cache.invalidate_object(classifier)
+    if doc is not None:
+        classifier_cache.invalidate(doc.get('sensor_id'), doc.get('user_id'))
+
+    delete_model_files(doc)
 
-def dataset(sensor_id, user_id):
+    return result.deleted_count
+
+def dataset(sensor_id, user_id, feature_version=None):
     '''Returns a training set for a virtual sensor
 
     Returns a training set for a virutla sensor. The training set consisting of samples,
@@ -304,15 +839,24 @@ def dataset(sensor_id, user_id):
     data and a label. The timeseries data is extracted from InfluxDB based on MLSamples
     instances stored in MongoDB.
 
+    When feature_version is given, features extracted in previous training runs are
+    loaded from the feature store (see store_features). Timeseries data is fetched only
+    for samples without stored features.
+
     Args:
         sensor_id: An object ID of a virutal sensor
         user_id: A user ID of a user who perfrom this operation
+        feature_version: A version of the classifier's feature extraction, or None
+            to fetch timeseries data for all samples
 
     Returns: A dictionary consisting of:
         {
             'data':[
                 {
-                    'timeseries': An array of timeseries data from real sensors
+                    'sample_id': An object ID of a sample
+                    'timeseries': An array of timeseries data from real sensors,
+                        or None if the sample has stored features
+                    'features': Stored features of a sample, or None
                     'lable': A label for a sample
                 },
                 { more samples }
@@ -320,6 +864,7 @@ def dataset(sensor_id, user_id):
             'sampling_period': An average sampling period in seconds.
                 The sampling_period when making a prediction is deciced by this value
             'label': An array of labels (i.e., potential predictions)
+            'feature_key': A key of the feature store for this training set, or None
         }
     '''
     data = []
@@ -331,20 +876,121 @@ def dataset(sensor_id, user_id):
     if len(smpls) == 0:
         return None
 
+    snsr = sensor(sensor_id, user_id)
+
+    key = None
+    stored = {}
+    if feature_version is not None:
+        key = feature_key(feature_version, snsr.inputs)
+        stored = stored_features(sensor_id, user_id, key)
+
+    # Load timeseries data for all samples without stored features at once
+    # instead of one query per sample and input (see timeseries_for_windows)
+    missing = [sample for sample in smpls if sample.object_id not in stored]
+    windows = [(sample.start_time, sample.end_time) for sample in missing]
+    fetched = {}
+    if len(missing) > 0:
+        for sample, raw_data in zip(missing, timeseries_for_windows(snsr.inputs, windows)):
+            fetched[sample.object_id] = raw_data
+
     for sample in smpls:
         sampling_period_sum = sampling_period_sum + sample.end_time - sample.start_time
 
-        raw_data = timeseries_for_sample(sample.object_id, user_id)
-
         if sample.label not in labels:
             labels.append(sample.label)
         
-        data.append({'timeseries':raw_data, 'label':sample.label})
-
-    dataset = {'data':data, 'sampling_period':sampling_period_sum/len(data), 'labels':labels}
+        data.append({
+            'sample_id':sample.object_id,
+            'timeseries':fetched.get(sample.object_id),
+            'features':stored.get(sample.object_id),
+            'label':sample.label
+        })
+
+    dataset = {
+        'data':data,
+        'sampling_period':sampling_period_sum/len(data),
+        'labels':labels,
+        'feature_key':key
+    }
 
     return dataset
 
+def feature_key(feature_version, input_uuids):
+    '''Returns a key of the feature store
+
+    Stored features are valid only for the same feature extraction and the same
+    real sensors, so both are part of the key.
+
+    Args:
+        feature_version: A version of a classifier's feature extraction
+        input_uuids: An array of real sensors' UUIDs of a virtual sensor
+
+    Returns:
+        A string key
+    '''
+    return '%s|%s' % (feature_version, ','.join(input_uuids))
+
+def stored_features(sensor_id, user_id, key):
+    '''Returns stored features of samples
+
+    Args:
+        sensor_id: An object ID of a virtual sensor
+        user_id: A user ID of a user who perform this operation
+        key: A key returned by feature_key
+
+    Returns:
+        A dictionary that maps object IDs of samples to their feature ndarrays
+    '''
+    condition = {'sensor_id':sensor_id, 'user_id':user_id, 'feature_key':key}
+    result = mongo_database().features.find(condition, {'sample_id':True, 'features':True})
+
+    features = {}
+    for row in result:
+        features[row['sample_id']] = np.array(row['features'], dtype='float')
+
+    return features
+
+def store_features(sensor_id, user_id, dataset):
+    '''Stores features of samples in the feature store
+
+    Stores features that were extracted from fetched timeseries data (i.e., samples
+    that did not have stored features) so that later training runs can reuse them.
+    Call this function after a classifier extracted features from the dataset.
+
+    Args:
+        sensor_id: An object ID of a virtual sensor
+        user_id: A user ID of a user who perform this operation
+        dataset: A training set returned by dataset
+
+    Returns:
+        The number of stored samples
+    '''
+    key = dataset.get('feature_key')
+    if key is None:
+        return 0
+
+    docs = []
+    for sample in dataset['data']:
+        if sample['timeseries'] is None or sample.get('features') is None:
+            continue
+
+        docs.append({
+            'sample_id':sample['sample_id'],
+            'sensor_id':sensor_id,
+            'user_id':user_id,
+            'feature_key':key,
+            'features':np.asarray(sample['features'], dtype='float').tolist()
+        })
+
+    if len(docs) == 0:
+        return 0
+
+    sample_ids = [doc['sample_id'] for doc in docs]
+    mongo_database().features.delete_many({'feature_key':key, 'sample_id':{'$in':sample_ids}})
+    mongo_database().features.insert_many(docs)
+
+    return len(docs)
+
 def timeseries_for_sample(sample_id, user_id):
     '''Returns timeseries data for a given sample
 
@@ -363,7 +1009,7 @@ def timeseries_for_sample(sample_id, user_id):
         sampling rates. Thus the return value is one-dimensional array of
         one-dimensional arrays, not a two-dimensional array.
     '''
-    result = mongo_client.samples.find({'_id':ObjectId(sample_id)})
+    result = mongo_database().samples.find({'_id':ObjectId(sample_id)})
     if result.count != 0:
         sample = MLSample(result[0])
     else:
@@ -374,40 +1020,228 @@ def timeseries_for_sample(sample_id, user_id):
 
     return samples
 
-def timeseries_for_inputs(input_uuids, start_time, end_time):
+def timeseries_for_inputs(input_uuids, start_time, end_time, concurrency=None):
     '''Returns timeseries data for given real sensors
 
     Returns an array of timeseries data for real sensors between start_time and
-    end_time.
+    end_time. Requests for the real sensors are sent to BuildingDepot in parallel,
+    so the latency is close to that of the slowest request rather than the sum
+    of all requests.
 
     Args:
-        sample_id: An object ID of a sample
-        user_id: A user ID of a user who perform this operaiton
+        input_uuids: An array of real sensors' UUIDs
+        start_time: A unix timestamp
+        end_time: A unix timestamp
+        concurrency: The maximum number of requests in flight at the same time.
+            TIMESERIES_FETCH_CONCURRENCY is used when omitted. 1 fetches the
+            real sensors one by one.
 
     Returns:
-        An array of timeseris data from multiple real sensors. Note that the lenghts
-        of real time data vary among the real sensors because of their differences in
-        sampling rates. Thus the return value is one-dimensional array of
-        one-dimensional arrays, not a two-dimensional array.
+        An array of timeseris data from multiple real sensors in the order of
+        input_uuids. Note that the lenghts of real time data vary among the real
+        sensors because of their differences in sampling rates. Thus the return
+        value is one-dimensional array of one-dimensional arrays, not a
+        two-dimensional array.
     '''
-    samples = []
+    def fetch(uuid):
+        timestamps, values = fetch_timeseries(uuid, start_time, end_time)
+        return values
 
-    for uuid in input_uuids:
-        values = buildingdepot_helper.get_timeseries_data(uuid, start_time, end_time)
-        samples.append(values)
-        
-    return samples
+    return map_concurrently(fetch, input_uuids, concurrency)
+
+def fetch_timeseries(uuid, start_time, end_time):
+    '''Returns timeseries data with timestamps for a real sensor
+
+    Looks up timeseries_cache first and queries BuildingDepot on a miss.
+    Historical windows fetched from BuildingDepot are stored in the cache.
+
+    Args:
+        uuid: A UUID of a real sensor
+        start_time: A unix timestamp
+        end_time: A unix timestamp
+
+    Returns:
+        (timestamps, values): An array of unix timestamps and an array of
+            readings at these timestamps
+    '''
+    cache = timeseries_cache()
+    cacheable = cache is not None and cache.cacheable(end_time)
+    if cacheable:
+        with metrics.stage('timeseries_cache_read'):
+            cached = cache.get(uuid, start_time, end_time)
+        if cached is not None:
+            return cached
+
+    with metrics.stage('buildingdepot_fetch'):
+        timestamps, values = buildingdepot().get_timeseries(uuid, start_time, end_time)
+    if cacheable:
+        cache.put(uuid, start_time, end_time, timestamps, values)
+
+    return timestamps, values
+
+def timeseries_for_windows(input_uuids, windows, concurrency=None, gap=None):
+    '''Returns timeseries data for given real sensors in multiple time windows
+
+    Loads timeseries data for many windows (e.g., all samples in a training set)
+    with as few BuildingDepot queries as possible. Overlapping or adjacent windows
+    are merged into a minimal set of time ranges (see merge_time_ranges), each range
+    is fetched once per real sensor, and the data for each window is sliced out of
+    the fetched ranges locally. Both ends of a window are inclusive.
+
+    Args:
+        input_uuids: An array of real sensors' UUIDs
+        windows: An array of (start_time, end_time) tuples
+        concurrency: The maximum number of requests in flight at the same time.
+            TIMESERIES_FETCH_CONCURRENCY is used when omitted.
+        gap: Windows separated by at most gap seconds are merged.
+            TIMESERIES_MERGE_GAP is used when omitted.
+
+    Returns:
+        An array with one entry per window, in the order of windows. Each entry is
+        an array of timeseries data from the real sensors in the order of
+        input_uuids, as returned by timeseries_for_inputs.
+    '''
+    queries = [(input_uuids, start_time, end_time) for start_time, end_time in windows]
+
+    return timeseries_for_queries(queries, concurrency, gap)
+
+def timeseries_for_queries(queries, concurrency=None, gap=None):
+    '''Returns timeseries data for multiple sets of real sensors and time windows
+
+    Generalizes timeseries_for_windows to queries on different sets of real sensors
+    (e.g., predictions for many virtual sensors). The windows requested for each
+    real sensor are merged across all queries, so a real sensor shared by several
+    queries is fetched only once per merged time range.
+
+    Args:
+        queries: An array of (input_uuids, start_time, end_time) tuples
+        concurrency: The maximum number of requests in flight at the same time.
+            TIMESERIES_FETCH_CONCURRENCY is used when omitted.
+        gap: Windows separated by at most gap seconds are merged.
+            TIMESERIES_MERGE_GAP is used when omitted.
+
+    Returns:
+        An array with one entry per query, in the order of queries. Each entry is
+        an array of timeseries data from the real sensors in the order of the
+        query's input_uuids, as returned by timeseries_for_inputs. The arrays are
+        slices of the fetched ranges, so data served from timeseries_cache are
+        read-only views of memory-mapped files.
+    '''
+    if gap is None:
+        gap = TIMESERIES_MERGE_GAP
+
+    # Merge the windows requested for each real sensor
+    windows = {}
+    for input_uuids, start_time, end_time in queries:
+        for uuid in input_uuids:
+            windows.setdefault(uuid, []).append((start_time, end_time))
+
+    uuids = list(windows.keys())
+    ranges = [merge_time_ranges(windows[uuid], gap) for uuid in uuids]
+    fetches = [(uuid, start, end) for uuid, uuid_ranges in zip(uuids, ranges) for start, end in uuid_ranges]
+
+    def fetch(query):
+        return fetch_timeseries(*query)
+
+    results = map_concurrently(fetch, fetches, concurrency)
+
+    # Keep the fetched ranges of each real sensor apart. Every window lies in
+    # one merged range, so it is sliced from that range without concatenating
+    # the ranges. np.asarray does not copy float arrays (e.g., cache entries).
+    series = {}
+    offset = 0
+    for uuid, uuid_ranges in zip(uuids, ranges):
+        range_results = results[offset:offset+len(uuid_ranges)]
+        offset += len(uuid_ranges)
+        series[uuid] = (
+            [start for start, end in uuid_ranges],
+            [(np.asarray(r[0], dtype='float'), np.asarray(r[1], dtype='float')) for r in range_results])
+
+    # Slices are views of the fetched arrays, not copies
+    timeseries = []
+    for input_uuids, start_time, end_time in queries:
+        window_data = []
+        for uuid in input_uuids:
+            starts, range_data = series[uuid]
+            timestamps, values = range_data[max(0, bisect.bisect_right(starts, start_time) - 1)]
+            first = np.searchsorted(timestamps, start_time, side='left')
+            last = np.searchsorted(timestamps, end_time, side='right')
+            window_data.append(values[first:last])
+        timeseries.append(window_data)
+
+    return timeseries
+
+def merge_time_ranges(windows, gap=0):
+    '''Merges time windows into a minimal set of disjoint time ranges
+
+    Args:
+        windows: An array of (start_time, end_time) tuples
+        gap: Windows separated by at most gap seconds are merged
+
+    Returns:
+        A sorted array of disjoint (start_time, end_time) tuples that covers
+        all windows
+    '''
+    ranges = []
+    for start_time, end_time in sorted(windows):
+        if len(ranges) > 0 and start_time <= ranges[-1][1] + gap:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end_time))
+        else:
+            ranges.append((start_time, end_time))
+
+    return ranges
+
+def map_concurrently(function, items, concurrency=None):
+    '''Applies a function to items on a bounded thread pool
+
+    Used to send requests to BuildingDepot in parallel. Pools are created once per
+    concurrency level and shared by all callers, because starting and joining a
+    ThreadPool for each call costs about 100 ms.
+
+    Args:
+        function: A function that takes an item
+        items: An array of items
+        concurrency: The maximum number of function calls running at the same time.
+            TIMESERIES_FETCH_CONCURRENCY is used when omitted. 1 calls the function
+            for each item one by one.
+
+    Returns:
+        An array of return values in the order of items
+    '''
+    if concurrency is None:
+        concurrency = TIMESERIES_FETCH_CONCURRENCY
+
+    if concurrency <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    with thread_pools_lock:
+        pool = thread_pools.get(concurrency)
+        if pool is None:
+            pool = ThreadPool(concurrency)
+            thread_pools[concurrency] = pool
+
+    # ThreadPool.map keeps results in the order of items
+    return pool.map(function, items)
+
+# Thread pools used by map_concurrently. concurrency -> ThreadPool
+thread_pools = {}
+thread_pools_lock = threading.Lock()
       
 
-def latest_timeseries_for_inputs(input_uuids, seconds):
+def latest_timeseries_for_inputs(input_uuids, seconds, concurrency=None):
     '''Returns timeseries data for given real sensors in the last specified seconds
 
     Returns an array of timeseries data for real sensors specified by input_uuids
-    in the last specified seconds.
+    in the last specified seconds. The data is read from ring buffers of recent
+    readings kept by stream_ingestor, so this function does not wait for the
+    sampling period to elapse. The window ends at the newest reading available
+    for all the real sensors. When recent readings are not available, the last
+    specified seconds are queried from BuildingDepot directly.
 
     Args:
         input_uuids: An array of real sensors' UUIDs
         seconds: A duration of sampling in seconds
+        concurrency: The maximum number of requests in flight at the same time
 
     Returns:
         An array of timeseris data from multiple real sensors. Note that the lenghts
@@ -415,10 +1249,31 @@ def latest_timeseries_for_inputs(input_uuids, seconds):
         sampling rates. Thus the return value is one-dimensional array of
         one-dimensional arrays, not a two-dimensional array.
     '''
+    timeseries = stream_ingestor().latest(input_uuids, seconds)
+    if timeseries is not None:
+        return timeseries
+
     current_time = time.time()
-    time.sleep(2+seconds)
 
-    return timeseries_for_inputs(input_uuids, current_time, current_time+seconds)
+    return timeseries_for_inputs(input_uuids, current_time-seconds, current_time, concurrency)
+
+def latest_features_for_inputs(input_uuids, seconds):
+    '''Returns features of given real sensors in the last specified seconds
+
+    The features are kept up to date incrementally by sliding feature windows of
+    stream_ingestor (see MLStreamIngestor.latest_features), so the cost does not
+    depend on the length of the window. Each real sensor's window ends at its own
+    newest reading.
+
+    Args:
+        input_uuids: An array of real sensors' UUIDs
+        seconds: A duration of sampling in seconds
+
+    Returns:
+        A ndarray of features in the layout of MLClassifier.preprocess, or None if
+        recent readings are not available
+    '''
+    return stream_ingestor().latest_features(input_uuids, seconds)
 
 
 def timestamp_to_time_string(t):
@@ -58,3 +58,28 @@ class MLSample:
 
         return data
 
+def validate_sample(dictionary):
+    '''Checks a sample given by a client before it is inserted
+
+    Args:
+        dictionary: A dictionary with 'start_time', 'end_time', and 'label'
+
+    Returns:
+        A human readable error message, or None if the sample is valid
+    '''
+    if not isinstance(dictionary, dict):
+        return 'A sample must be a JSON object.'
+
+    for key in ('start_time', 'end_time'):
+        value = dictionary.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+            return '%s must be a unix timestamp.' % key
+
+    if dictionary['end_time'] <= dictionary['start_time']:
+        return 'end_time must be later than start_time.'
+
+    label = dictionary.get('label')
+    if not isinstance(label, basestring) or label == '':
+        return 'label must be a non-empty string.'
+
+    return None
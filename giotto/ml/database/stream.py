@@ -0,0 +1,308 @@
+"""Streaming ingestion of recent sensor readings
+
+Keeps a time-bounded ring buffer of recent readings for each real sensor used
+by "latest" predictions. A background thread polls BuildingDepot for new readings
+of the tracked sensors, so a prediction can read the last sampling period from
+memory and return right away instead of waiting for the period to elapse.
+Optionally, features of the last sampling period are also kept up to date as
+readings arrive (see giotto.ml.classifier.streaming).
+"""
+import time
+import threading
+
+import numpy as np
+
+from giotto.ml.classifier.streaming import MLSlidingWindowFeatures
+from giotto.helper import metrics
+
+poll_failures = metrics.registry.register(metrics.Counter(
+    'giotto_stream_poll_failures_total',
+    'Polls of BuildingDepot for new readings of tracked sensors that failed',
+    ('error',)))
+
+class MLRingBuffer:
+    '''A ring buffer of (timestamp, value) readings covering a bounded time span
+
+    Readings older than retention seconds before the newest reading are dropped
+    when new readings are added. The buffer grows when the retention span holds
+    more readings than its capacity.
+    '''
+    def __init__(self, retention, capacity=1024):
+        '''Initializes an empty buffer
+
+        Args:
+            retention: A time span in seconds to keep
+            capacity: The initial number of readings the buffer can hold
+        '''
+        self.retention = retention
+        self.timestamps = np.zeros(capacity)
+        self.values = np.zeros(capacity)
+        self.start = 0
+        self.count = 0
+
+    def latest_timestamp(self):
+        '''Returns the timestamp of the newest reading, or None if the buffer is empty'''
+        if self.count == 0:
+            return None
+
+        return self.timestamps[(self.start + self.count - 1) % len(self.timestamps)]
+
+    def extend(self, timestamps, values):
+        '''Appends readings in timestamp order
+
+        Readings that are not newer than the newest reading in the buffer are ignored.
+
+        Args:
+            timestamps: An array of unix timestamps in ascending order
+            values: An array of readings at the timestamps
+        '''
+        timestamps = np.asarray(timestamps, dtype='float')
+        values = np.asarray(values, dtype='float')
+
+        latest = self.latest_timestamp()
+        if latest is not None:
+            newer = timestamps > latest
+            timestamps = timestamps[newer]
+            values = values[newer]
+
+        if len(timestamps) == 0:
+            return
+
+        # Drop readings that fall out of the retention span
+        oldest_kept = timestamps[-1] - self.retention
+        ordered = self.ordered_timestamps()
+        drop = np.searchsorted(ordered, oldest_kept, side='left')
+        self.start = (self.start + drop) % len(self.timestamps)
+        self.count -= drop
+
+        keep = timestamps >= oldest_kept
+        timestamps = timestamps[keep]
+        values = values[keep]
+
+        if self.count + len(timestamps) > len(self.timestamps):
+            self.grow(self.count + len(timestamps))
+
+        capacity = len(self.timestamps)
+        idx = (self.start + self.count + np.arange(len(timestamps))) % capacity
+        self.timestamps[idx] = timestamps
+        self.values[idx] = values
+        self.count += len(timestamps)
+
+    def window(self, start_time, end_time, with_timestamps=False):
+        '''Returns readings between start_time and end_time (both inclusive)
+
+        Returns values, or (timestamps, values) if with_timestamps is True.
+        '''
+        idx = self.ordered_index()
+        ordered = self.timestamps[idx]
+        first = np.searchsorted(ordered, start_time, side='left')
+        last = np.searchsorted(ordered, end_time, side='right')
+
+        if with_timestamps:
+            return ordered[first:last], self.values[idx[first:last]]
+
+        return self.values[idx[first:last]]
+
+    def ordered_index(self):
+        '''Returns indexes of readings in the buffer from the oldest to the newest'''
+        return (self.start + np.arange(self.count)) % len(self.timestamps)
+
+    def ordered_timestamps(self):
+        '''Returns timestamps in the buffer from the oldest to the newest'''
+        return self.timestamps[self.ordered_index()]
+
+    def grow(self, size):
+        '''Enlarges the buffer so that it can hold at least size readings'''
+        capacity = max(size, 2 * len(self.timestamps))
+        idx = self.ordered_index()
+
+        timestamps = np.zeros(capacity)
+        values = np.zeros(capacity)
+        timestamps[:self.count] = self.timestamps[idx]
+        values[:self.count] = self.values[idx]
+
+        self.timestamps = timestamps
+        self.values = values
+        self.start = 0
+
+class MLStreamIngestor:
+    '''Keeps ring buffers of recent readings for real sensors in use
+
+    A sensor is tracked from the first time its latest readings are requested.
+    While a sensor is tracked, a background thread polls BuildingDepot every
+    poll_interval seconds and appends new readings to its buffer. Sensors that
+    are not requested for idle_timeout seconds are no longer tracked.
+
+    When features of a sensor are requested with latest_features, a sliding
+    feature window is also kept for each requested span and fed with the new
+    readings, so the features are not recomputed from the whole window.
+    '''
+    def __init__(self, fetch_many, poll_interval=1.0, idle_timeout=600, max_lag=30):
+        '''Initializes an ingestor. The polling thread starts on the first request.
+
+        Args:
+            fetch_many: A function that takes an array of (uuid, start_time, end_time)
+                queries and returns an array of (timestamps, values) results
+            poll_interval: Seconds between polls
+            idle_timeout: Seconds after which a sensor not requested is untracked
+            max_lag: Readings are treated as unavailable when the newest reading
+                of a sensor is older than max_lag seconds plus the requested span
+        '''
+        self.fetch_many = fetch_many
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.max_lag = max_lag
+        self.buffers = {}       # uuid -> MLRingBuffer
+        self.last_access = {}   # uuid -> unix timestamp
+        self.feature_windows = {}   # uuid -> {seconds: MLSlidingWindowFeatures}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def latest(self, input_uuids, seconds):
+        '''Returns the latest readings of real sensors
+
+        The window ends at the newest reading that all sensors have, and spans
+        the preceding seconds. Sensors that are not tracked yet are tracked and
+        their buffers are filled with a single query.
+
+        Args:
+            input_uuids: An array of real sensors' UUIDs
+            seconds: A duration of sampling in seconds
+
+        Returns:
+            An array of timeseries data in the order of input_uuids, or None if
+            recent readings are not available for some of the sensors
+        '''
+        now = time.time()
+        self.track(input_uuids, seconds, now)
+
+        with self.lock:
+            latest = [self.buffers[uuid].latest_timestamp() for uuid in input_uuids]
+            if None in latest or min(latest) < now - seconds - self.max_lag:
+                return None
+
+            end_time = min(latest)
+            return [self.buffers[uuid].window(end_time - seconds, end_time) for uuid in input_uuids]
+
+    def latest_features(self, input_uuids, seconds):
+        '''Returns features of the latest readings of real sensors
+
+        Features of each sensor are computed over the last seconds up to its own
+        newest reading by a MLSlidingWindowFeatures instance, which is created and
+        filled from the buffer on the first request and updated as new readings
+        are ingested. Unlike latest, the windows of the sensors are not aligned to
+        a common end time.
+
+        Args:
+            input_uuids: An array of real sensors' UUIDs
+            seconds: A duration of sampling in seconds
+
+        Returns:
+            A ndarray of features in the layout of MLClassifier.preprocess, or None
+            if recent readings are not available for some of the sensors
+        '''
+        now = time.time()
+        self.track(input_uuids, seconds, now)
+
+        with self.lock:
+            features = []
+            for uuid in input_uuids:
+                buf = self.buffers[uuid]
+                latest = buf.latest_timestamp()
+                if latest is None or latest < now - seconds - self.max_lag:
+                    return None
+
+                windows = self.feature_windows.setdefault(uuid, {})
+                if seconds not in windows:
+                    windows[seconds] = MLSlidingWindowFeatures(seconds)
+                    windows[seconds].extend(*buf.window(latest - seconds, latest, True))
+
+                features.append(windows[seconds].features())
+
+        return np.concatenate(features)
+
+    def track(self, input_uuids, seconds, now):
+        '''Tracks real sensors and fills the buffers of new ones with a single query'''
+        self.start()
+        retention = 2 * seconds + self.max_lag
+
+        with self.lock:
+            new_uuids = []
+            for uuid in input_uuids:
+                self.last_access[uuid] = now
+                if uuid not in self.buffers:
+                    self.buffers[uuid] = MLRingBuffer(retention)
+                    new_uuids.append(uuid)
+                else:
+                    buf = self.buffers[uuid]
+                    buf.retention = max(buf.retention, retention)
+
+        if len(new_uuids) > 0:
+            queries = [(uuid, now - retention, now) for uuid in new_uuids]
+            self.ingest(queries, self.fetch_many(queries))
+
+    def ingest(self, queries, results):
+        '''Appends query results to the buffers of their sensors
+
+        Null readings are dropped, so that buffers and feature windows only hold numbers.
+        '''
+        with self.lock:
+            for (uuid, start_time, end_time), (timestamps, values) in zip(queries, results):
+                timestamps = np.asarray(timestamps, dtype='float')
+                values = np.asarray(values, dtype='float')
+                valid = np.isfinite(timestamps) & np.isfinite(values)
+                if not valid.all():
+                    timestamps = timestamps[valid]
+                    values = values[valid]
+
+                buf = self.buffers.get(uuid)
+                if buf is not None:
+                    buf.extend(timestamps, values)
+                for window in self.feature_windows.get(uuid, {}).values():
+                    window.extend(timestamps, values)
+
+    def poll(self):
+        '''Fetches new readings of all tracked sensors once'''
+        now = time.time()
+        queries = []
+
+        with self.lock:
+            for uuid in list(self.buffers.keys()):
+                if self.last_access[uuid] < now - self.idle_timeout:
+                    del self.buffers[uuid]
+                    del self.last_access[uuid]
+                    self.feature_windows.pop(uuid, None)
+                    continue
+
+                buf = self.buffers[uuid]
+                start_time = buf.latest_timestamp()
+                if start_time is None:
+                    start_time = now - buf.retention
+                queries.append((uuid, start_time, now))
+
+        if len(queries) > 0:
+            self.ingest(queries, self.fetch_many(queries))
+
+    def run(self):
+        '''Polls BuildingDepot until the process exits'''
+        while True:
+            started = time.time()
+            try:
+                self.poll()
+            except Exception as e:
+                # Keep polling. A failed poll is retried on the next interval
+                poll_failures.inc((type(e).__name__,))
+                print('A poll of recent readings failed: %s' % e)
+            time.sleep(max(0, self.poll_interval - (time.time() - started)))
+
+    def start(self):
+        '''Starts the polling thread if it is not running'''
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.thread = thread
@@ -0,0 +1,248 @@
+"""A local on-disk cache for historical timeseries data
+
+Historical sensor readings do not change, but every retraining fetches the same
+time windows from BuildingDepot again. The cache stores the timestamps and values
+of a (uuid, start_time, end_time) query as a compact float64 array on disk and
+reads it back memory-mapped, so repeated training runs are served locally. Windows
+are sliced from the mapped arrays without copying them
+(see giotto.ml.database.manager.timeseries_for_queries), and only the pages that
+are read are loaded.
+"""
+import os
+import stat
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+
+class MLTimeseriesCache:
+    '''A size-bounded on-disk cache of timeseries queries
+
+    Each entry is a .npy file holding a 2 x N float64 array. The first row is the
+    timestamps and the second row is the values, so each column of the query
+    result is stored contiguously. When the total size of the entries exceeds
+    max_bytes, the least recently used entries are deleted.
+
+    Only windows that ended at least min_age seconds ago are cached, because data
+    for recent windows may still be arriving at BuildingDepot.
+
+    Several processes (e.g., the REST API and the prediction scheduler) may share
+    a directory. Each process rescans the directory at most every rescan_interval
+    seconds when it stores an entry, so entries stored by other processes count
+    toward max_bytes after at most that delay.
+
+    Cache entries are read back as training data, so the directory must be
+    private to the user that runs the process.
+    '''
+    def __init__(self, directory, max_bytes=512*1024*1024, min_age=60, rescan_interval=10):
+        '''Opens a cache directory, creating it if it does not exist
+
+        Args:
+            directory: A path to a directory that holds cache entries
+            max_bytes: The maximum total size of cache entries in bytes
+            min_age: Windows that ended less than min_age seconds ago are not cached
+            rescan_interval: Seconds between rescans of the directory
+
+        Raises:
+            OSError: The directory cannot be created, or is not a directory
+                that only the current user can access
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.rescan_interval = rescan_interval
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        open_private_directory(directory)
+
+        # file name -> [size in bytes, last access time]
+        self.entries = {}
+        self.size = 0
+        self.scanned_at = 0
+        self.scan()
+
+    def scan(self):
+        '''Reloads the sizes and access times of entries from the directory
+
+        The caller must hold self.lock, except in __init__.
+        '''
+        entries = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                try:
+                    entry_stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue    # Evicted by another process
+                entries[name] = [entry_stat.st_size, entry_stat.st_mtime]
+
+        self.entries = entries
+        self.size = sum(entry[0] for entry in entries.values())
+        self.scanned_at = time.time()
+
+    def cacheable(self, end_time):
+        '''Returns True if a window ending at end_time can be cached'''
+        return float(end_time) <= time.time() - self.min_age
+
+    def get(self, uuid, start_time, end_time):
+        '''Returns cached timeseries data
+
+        Args:
+            uuid: A UUID of a real sensor
+            start_time: A unix timestamp
+            end_time: A unix timestamp
+
+        Returns:
+            (timestamps, values) as read-only memory-mapped arrays, or None if the
+            query is not cached
+        '''
+        name = self.file_name(uuid, start_time, end_time)
+        try:
+            columns = np.load(os.path.join(self.directory, name), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        now = time.time()
+        with self.lock:
+            self.hits += 1
+            if name in self.entries:
+                self.entries[name][1] = now
+        try:
+            # Persist the access time so that other processes evict in LRU order
+            os.utime(os.path.join(self.directory, name), (now, now))
+        except OSError:
+            pass
+
+        return columns[0], columns[1]
+
+    def put(self, uuid, start_time, end_time, timestamps, values):
+        '''Stores timeseries data in the cache
+
+        Data that cannot be represented as float arrays is not cached.
+
+        Args:
+            uuid: A UUID of a real sensor
+            start_time: A unix timestamp
+            end_time: A unix timestamp
+            timestamps: An array of unix timestamps
+            values: An array of readings at the timestamps
+
+        Returns:
+            True if the data was stored
+        '''
+        try:
+            columns = np.array([timestamps, values], dtype='float64').reshape(2, -1)
+        except (TypeError, ValueError):
+            return False
+
+        name = self.file_name(uuid, start_time, end_time)
+        path = os.path.join(self.directory, name)
+
+        # Write to a temporary file and rename it, so that readers never see a
+        # partially written entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, columns)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+
+        nbytes = os.path.getsize(path)
+        with self.lock:
+            if time.time() - self.scanned_at >= self.rescan_interval:
+                self.scan()
+            if name in self.entries:
+                self.size -= self.entries[name][0]
+            self.entries[name] = [nbytes, time.time()]
+            self.size += nbytes
+            self.stores += 1
+            self.evict()
+
+        return True
+
+    def evict(self):
+        '''Deletes least recently used entries until the cache fits in max_bytes
+
+        The caller must hold self.lock.
+        '''
+        if self.size <= self.max_bytes:
+            return
+
+        by_access = sorted(self.entries.items(), key=lambda item: item[1][1])
+        for name, (nbytes, accessed) in by_access:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            del self.entries[name]
+            self.size -= nbytes
+            self.evictions += 1
+
+    def file_name(self, uuid, start_time, end_time):
+        '''Returns a file name of a cache entry for a query'''
+        key = '%s|%r|%r' % (uuid, float(start_time), float(end_time))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy'
+
+    def stats(self):
+        '''Returns a dictionary of cache counters
+
+        Returns:
+            {
+                'directory': A path to the cache directory
+                'max_bytes': The maximum total size of entries
+                'bytes': The current total size of entries
+                'entries': The current number of entries
+                'hits': The number of queries served from the cache
+                'misses': The number of queries not found in the cache
+                'stores': The number of queries stored in the cache
+                'evictions': The number of entries evicted because the cache was full
+                'hit_rate': hits / (hits + misses), or 0 if there was no lookup
+            }
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'directory': self.directory,
+                'max_bytes': self.max_bytes,
+                'bytes': self.size,
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups > 0 else 0.0
+            }
+
+def open_private_directory(directory):
+    '''Creates a directory only the current user can access, or checks an existing one
+
+    Raises:
+        OSError: The path is not a directory, is owned by another user, or can be
+            accessed by other users
+    '''
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    directory_stat = os.lstat(directory)
+    if not stat.S_ISDIR(directory_stat.st_mode):
+        raise OSError('%s is not a directory' % directory)
+    if hasattr(os, 'getuid') and directory_stat.st_uid != os.getuid():
+        raise OSError('%s is owned by another user' % directory)
+    if directory_stat.st_mode & 0o077:
+        raise OSError('%s can be accessed by other users (chmod 700 it)' % directory)
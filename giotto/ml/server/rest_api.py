@@ -1,14 +1,19 @@
 '''
 This module implements REST APIs for the GIoTTO machine learning layer
 '''
+import timeit
+import_started = timeit.default_timer()
+
 from flask import Flask
 from flask import request
-from pymongo import MongoClient
-from influxdb import InfluxDBClient
 import json
 import time
+import random
 from datetime import timedelta
-from flask import make_response, current_app
+from flask import make_response, current_app, g
+from flask import Response, stream_with_context
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from functools import update_wrapper
 
 import giotto.ml.database.manager as database_manager
@@ -18,10 +23,21 @@ from giotto.ml.database.sensor import MLSensor
 from giotto.ml.database.classifier import MLClassifier
 from giotto.ml.classifier.manager import MLClassifierResult
 from giotto.config.buildingdepot_setting import BuildingDepotSetting 
+from giotto.helper import metrics
+from giotto.helper.profiling import RequestProfiler
 
 
 app = Flask(__name__)
 
+# Requests are profiled when they have PROFILE_HEADER (e.g., "X-Giotto-Profile: 1"),
+# and a PROFILE_SAMPLE_RATE fraction of other requests is profiled at random.
+# The last PROFILE_HISTORY profiles are kept with their PROFILE_TOP hotspots.
+PROFILE_HEADER = 'X-Giotto-Profile'
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_HISTORY = 50
+PROFILE_TOP = 25
+request_profiler = RequestProfiler(PROFILE_HISTORY, PROFILE_TOP)
+
 
 def jsonString(obj,pretty=False):
     if pretty == True:
@@ -29,6 +45,138 @@ def jsonString(obj,pretty=False):
     else:
         return json.dumps(obj)
 
+# List endpoints write this many items per chunk of a streamed response
+STREAM_CHUNK_SIZE = 100
+
+def flag_argument(value, default):
+    '''Parses a flag given as a URL parameter or in JSON data
+
+    Strings "false", "0", and "no" (in any case), false, and 0 are false, and
+    other values are true.
+
+    Args:
+        value: A string, a boolean, a number, or None when the flag is omitted
+        default: The value returned when the flag is omitted
+
+    Returns:
+        True or False
+    '''
+    if value is None:
+        return default
+
+    return str(value).lower() not in ('false', '0', 'no')
+
+def page_arguments():
+    '''Reads the pagination arguments of a list request
+
+    Args as URL parameters:
+        limit: The maximum number of items in a page. All items when omitted.
+        after: An object ID returned as "next" by the previous page
+
+    Returns:
+        (limit, after, message): message is a human readable error message when
+            the arguments are invalid, otherwise None
+    '''
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return None, None, 'limit must be a positive integer.'
+
+    if after is not None and not ObjectId.is_valid(after):
+        return None, None, 'after must be an object ID.'
+
+    return limit, after, None
+
+def stream_list(dic, items, limit):
+    '''Streams a JSON response whose "ret" is an array of items
+
+    Items are serialized and written in chunks while they are read, so memory use
+    does not depend on the number of items. The response is dic with "ret" and
+    "next" added. "next" is the object ID to pass as "after" to get the next page,
+    or null when there are no more items.
+
+    Args:
+        dic: A dictionary of the other fields of the response
+        items: An iterator of (object ID, dictionary) pairs. When limit is given,
+            it should yield up to limit + 1 pairs, so that the last page is detected.
+        limit: The maximum number of items in the response, or None for no limit
+
+    Returns:
+        A Flask Response
+    '''
+    def generate():
+        yield json.dumps(dic)[:-1] + ', "ret": ['
+
+        count = 0
+        last_id = None
+        more = False
+        chunk = []
+        for object_id, item in items:
+            if limit is not None and count == limit:
+                more = True
+                break
+
+            chunk.append(json.dumps(item))
+            count += 1
+            last_id = object_id
+            if len(chunk) == STREAM_CHUNK_SIZE:
+                yield (', ' if count > len(chunk) else '') + ', '.join(chunk)
+                chunk = []
+
+        if len(chunk) > 0:
+            yield (', ' if count > len(chunk) else '') + ', '.join(chunk)
+
+        yield '], "next": %s}' % json.dumps(last_id if more else None)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = timeit.default_timer()
+
+@app.after_request
+def record_request_metrics(response):
+    '''Records the count and latency of a request per endpoint
+
+    Endpoints are labeled with their URL rules (e.g., /sensor/<sensor_id>) rather
+    than actual URLs, so that the number of time series stays bounded.
+    '''
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.http_requests.inc((endpoint, request.method, str(response.status_code)))
+        metrics.http_request_duration.observe(timeit.default_timer() - started, (endpoint, request.method))
+
+    return response
+
+@app.before_request
+def start_request_profile():
+    '''Starts profiling a request that asks for it or is sampled'''
+    if request.path.startswith('/profiles') or request.path == '/metrics':
+        return
+
+    requested = request.headers.get(PROFILE_HEADER, '').lower() in ('1', 'true', 'yes')
+    if requested or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        g.request_profile = request_profiler.start()
+
+@app.after_request
+def finish_request_profile(response):
+    '''Stores the profile of a profiled request and returns its ID in a header'''
+    profile = getattr(g, 'request_profile', None)
+    if profile is not None:
+        g.request_profile = None
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_profiler.finish(profile, request.url, request.method, endpoint, response.status_code)
+        response.headers[PROFILE_HEADER + '-Id'] = profile.profile_id
+
+    return response
+
 @app.route("/")
 def message():
     return "Building Depot Flask Server for the GIoTTO Machine Learning Layer"
@@ -110,12 +258,17 @@ def getAllSensors():
     '''Returns a list of all virtual sensors.
 
     Returns a list of all virtual sensors in the ML layer as an array of objects.
+    The response is streamed, and can be split into pages with "limit" and "after".
+
+    Args as URL parameters:
+        limit: The maximum number of sensors in a page. All sensors when omitted.
+        after: "next" of the previous page
 
     Returns:
         {
             "url": A URL of the HTTP call
             "method": "GET"
-            "result": "ok"
+            "result": error when the arguments are invalid, otherwise ok
             "ret":[
                 {
                     "_id": A virtual sensor's object ID
@@ -128,26 +281,31 @@ def getAllSensors():
                 },
                 { More sensor objects if there are }
             ]
+            "next": An object ID to pass as "after" for the next page, or null
+                at the last page
         }
     '''
     # When access control is fully implemented. user_id has to be identified
     # based on OAuth header of a http request. However, it's not implemented yet
     # Thus 'default' is used here
     user_id = 'default'
-    
-    sensors = database_manager.sensors(user_id)
-    result = []
-    for sensor in sensors:
-        result.append(sensor)
 
     dic = {
         'url':request.url,
-        'method':request.method,
-        'result':'ok',
-        'ret':result
+        'method':request.method
     }
 
-    return jsonString(dic)
+    limit, after, message = page_arguments()
+    if message is not None:
+        dic['result'] = 'error'
+        dic['message'] = message
+        return jsonString(dic)
+
+    dic['result'] = 'ok'
+    sensors = database_manager.iterate_sensors(user_id, after, limit + 1 if limit is not None else None)
+    items = ((sensor._id, sensor.to_dictionary()) for sensor in sensors)
+
+    return stream_list(dic, items, limit)
 
 
 @app.route('/sensor/<sensor_id>', methods=['GET'])
@@ -319,36 +477,160 @@ def insert_sample(sensor_id):
 
     return jsonString(dic)
 
+@app.route('/sensor/<sensor_id>/samples', methods=['POST'])
+def insert_samples(sensor_id):
+    '''Adds many training samples to a virtual sensor at once
+
+    Samples are validated and written in bulk (see database.manager.insert_samples).
+    The body is either JSON or NDJSON (Content-Type: application/x-ndjson) with
+    one sample per line. NDJSON is read as a stream, so very large uploads do not
+    have to fit in memory as one JSON document.
+
+    Args as a part of URL:
+        <sensor_id>: An object ID of a virtual sensor
+
+    Args as URL parameters:
+        ordered: "false" to insert every valid sample even after an error.
+            By default, processing stops at the first invalid or failed sample.
+
+    Args as data:
+        [
+            {
+                "start_time": A unix timestamp denoting when a sample starts
+                "end_time": A unix timestamp denoting when a sample ends
+                "label": A label string
+            },
+            { more samples }
+        ]
+        or {"samples": [samples], "ordered": true or false}
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "POST"
+            "result": ok when all samples were inserted, otherwise error
+            "message": A human readable message
+            "inserted": The number of inserted samples
+            "failed": The number of samples that were not inserted
+            "ret":[
+                {
+                    "sample_id": An object ID of an inserted sample, or null
+                    "error": An error message, or null when the sample was inserted
+                },
+                { more results in the order of the request }
+            ]
+        }
+    '''
+    user_id = 'default'
+    dic = {
+        'url':request.url,
+        'method':request.method
+    }
+
+    try:
+        exists = database_manager.sensor_exists(sensor_id, user_id)
+    except (InvalidId, TypeError):
+        exists = False
+
+    if not exists:
+        dic['result'] = 'error'
+        dic['message'] = 'The sensor not found.'
+        return jsonString(dic)
+
+    ordered = flag_argument(request.args.get('ordered'), True)
+
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        samples = ndjson_items(request.stream)
+    else:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and isinstance(data.get('samples'), list):
+            samples = data['samples']
+            ordered = flag_argument(data.get('ordered'), ordered)
+        elif isinstance(data, list):
+            samples = data
+        else:
+            dic['result'] = 'error'
+            dic['message'] = 'An array of samples is required.'
+            return jsonString(dic)
+
+    results = database_manager.insert_samples(sensor_id, user_id, samples, ordered)
+    inserted = sum(1 for result in results if result['error'] is None)
+
+    dic['result'] = 'ok' if inserted == len(results) else 'error'
+    dic['message'] = '%d of %d samples were inserted' % (inserted, len(results))
+    dic['inserted'] = inserted
+    dic['failed'] = len(results) - inserted
+    dic['ret'] = results
+
+    return jsonString(dic)
+
+def ndjson_items(stream):
+    '''Yields a parsed JSON value per non-empty line of a stream
+
+    A line that is not valid JSON yields None, which insert_samples reports as
+    an invalid sample.
+    '''
+    for line in stream:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        try:
+            yield json.loads(line.decode('utf-8'))
+        except ValueError:
+            yield None
+
 @app.route('/sensor/<sensor_id>/samples', methods=['GET'])
 def get_samples(sensor_id):
     '''Returns an array of samples for a virtual sensor
 
+    The response is streamed, and can be split into pages with "limit" and "after".
+
     Args as a part of URL:
         <sensor_id>: An object ID of a virtual sensor
 
+    Args as URL parameters:
+        limit: The maximum number of samples in a page. All samples when omitted.
+        after: "next" of the previous page
+
     Returns:
         {
             "url": A URL of the HTTP call
             "method": "GET"
-            "result": error when read failed, otherwise ok
-            "ret": An array of sample objects
+            "result": error when the arguments are invalid, otherwise ok
+            "ret":[
+                {
+                    "sample_id": An object ID of a sample
+                    "sensor_id": An object ID of the virtual sensor
+                    "user_id": A user ID of an owner of the sample
+                    "start_time": A unix timestamp when the sample starts
+                    "end_time": A unix timestamp when the sample ends
+                    "label": A label of the sample
+                },
+                { more samples }
+            ]
+            "next": An object ID to pass as "after" for the next page, or null
+                at the last page
         }
     '''
     user_id = 'default'
 
-    samples = database_manager.samples(sensor_id, user_id)
     dic = {
         'url':request.url,
-        'method':request.method,
+        'method':request.method
     }
 
-    if samples is not None:
-        dic['result']='ok'
-        dic['ret']=samples
-    else:
-        dic['result']='error'
+    limit, after, message = page_arguments()
+    if message is not None:
+        dic['result'] = 'error'
+        dic['message'] = message
+        return jsonString(dic)
+
+    dic['result'] = 'ok'
+    samples = database_manager.iterate_samples(sensor_id, user_id, after, limit + 1 if limit is not None else None)
+    items = ((sample.object_id, sample.to_dictionary()) for sample in samples)
 
-    return json.dumps(result)
+    return stream_list(dic, items, limit)
 
 @app.route('/sensor/<sensor_id>/samples', methods=['DELETE'])
 def delete_samples(sensor_id):
@@ -373,29 +655,85 @@ def train(sensor_id):
 
     Trains a classifier for a virtual sensor using its samples as a training set.
     A trained classifier is stored in a database and can be used to make predictions. 
+    Training runs in the background. This API returns a training job right away,
+    and the job's status can be checked with /classifier/jobs/<job_id>. When the
+    virtual sensor is already being trained, the existing job is returned.
+
+    With tune=true, parameters of the classifier are chosen with a cross-validated
+    search before training (see giotto.ml.classifier.tuning). The chosen parameters
+    are kept by later training runs.
 
     Args as a part of URL:
     <sensor_id>: An object ID of a virtual sensor_id
 
+    Args as URL parameters:
+    tune: true to search parameters of the classifier (default: false)
+
     Returns:
         {
             "url": A URL of the HTTP call
             "method": "POST"
-            "result": Error when training failed, otherwise ok
-            "message": A human readable message from classifier.manager.train
+            "result": ok
+            "message": A human readable message
+            "ret": A training job (see get_training_job)
         }
     '''
     user_id = 'default'
-    classifier_result = classifier_manager.train(sensor_id, user_id)
+    tune = request.args.get('tune', 'false').lower() in ('true', '1', 'yes')
+    job = classifier_manager.submit_training(sensor_id, user_id, tune)
     dic = {
         'url':request.url,
         'method':request.method,
-        'result':classifier_result.result,
-        'message':classifier_result.message
+        'result':'ok',
+        'message':'A training job was submitted',
+        'ret':job.to_dictionary()
     }
 
     return jsonString(dic)
 
+@app.route('/classifier/jobs/<job_id>', methods=['GET'])
+def get_training_job(job_id):
+    '''Returns the status of a training job
+
+    Args as a part of URL:
+    <job_id>: A job ID returned by /sensor/<sensor_id>/classifier/train
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "GET"
+            "result": error when the job is not found, otherwise ok
+            "ret":{
+                "job_id": A job ID
+                "sensor_id": An object ID of a virtual sensor
+                "user_id": A user ID of an owner of the virtual sensor
+                "tune": true if parameters are searched before training
+                "status": queued, running, done, or error
+                "stage": The current stage of training (loading, tuning, training, or storing)
+                "progress": Progress between 0 and 1
+                "message": A human readable message from classifier.manager.train
+                "submitted_at": A unix timestamp when the job was submitted
+                "started_at": A unix timestamp when the job started, or null
+                "finished_at": A unix timestamp when the job finished, or null
+                "wait_time": Seconds the job waited in the queue
+                "run_time": Seconds the job has been running
+            }
+        }
+    '''
+    job = classifier_manager.training_job(job_id)
+    dic = {
+        'url':request.url,
+        'method':request.method,
+    }
+
+    if job is not None:
+        dic['result'] = 'ok'
+        dic['ret'] = job.to_dictionary()
+    else:
+        dic['result'] = 'error'
+
+    return jsonString(dic)
+
 @app.route('/sensor/<sensor_id>/classifier/predict', methods=['GET'])
 def predict(sensor_id):
     '''Makes a prediction using a classifier
@@ -434,6 +772,371 @@ def predict(sensor_id):
 
     return jsonString(dic) 
 
+@app.route('/classifiers/predict', methods=['POST'])
+def predict_batch():
+    '''Makes predictions for many virtual sensors and time windows
+
+    Makes a prediction for each pair of a virtual sensor and an end time in one
+    request. Timeseries data shared by the predictions is fetched once, and the
+    predictions of each virtual sensor are made together.
+
+    Args as data:
+        {
+            "predictions":[
+                {
+                    "sensor_id": An object ID of a virtual sensor
+                    "time": A unix timestamp used as the end time. When omitted,
+                        the latest readings are used.
+                },
+                { more predictions }
+            ]
+        }
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "POST"
+            "result": error when the request is malformed, otherwise ok
+            "ret":[
+                {
+                    "sensor_id": An object ID of a virtual sensor
+                    "time": The unix timestamp given in the request
+                    "result": Error when prediction failed, otherwise ok
+                    "message": A human readable message
+                    "ret": A predicted label
+                },
+                { more predictions in the order of the request }
+            ]
+        }
+    '''
+    user_id = 'default'
+    dic = {
+        'url':request.url,
+        'method':request.method
+    }
+
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get('predictions'), list) or \
+            not all(isinstance(query, dict) for query in data['predictions']):
+        dic['result'] = 'error'
+        dic['message'] = 'An array of predictions is required.'
+        return jsonString(dic)
+
+    queries = data['predictions']
+    clf_results = classifier_manager.predict_batch(queries, user_id)
+
+    ret = []
+    for query, clf_result in zip(queries, clf_results):
+        ret.append({
+            'sensor_id': query.get('sensor_id'),
+            'time': query.get('time'),
+            'result': clf_result.result,
+            'message': clf_result.message,
+            'ret': clf_result.prediction
+        })
+
+    dic['result'] = 'ok'
+    dic['ret'] = ret
+
+    return jsonString(dic)
+
+
+def classifier_metadata_dictionary(metadata):
+    '''Converts classifier metadata from the database into a JSON serializable dictionary'''
+    dic = dict(metadata)
+    dic['_id'] = str(dic['_id'])
+    for field in ('blob_id', 'compiled_id'):
+        if dic.get(field) is not None:
+            dic[field] = str(dic[field])
+
+    return dic
+
+@app.route('/classifiers', methods=['GET'])
+def get_classifiers():
+    '''Returns metadata of all classifiers
+
+    Serialized models are not read from the database.
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "GET"
+            "result": "ok"
+            "ret":[
+                (metadata of a classifier, see get_classifier),
+                { more classifiers }
+            ]
+        }
+    '''
+    user_id = 'default'
+    dic = {
+        'url':request.url,
+        'method':request.method,
+        'result':'ok',
+        'ret':[classifier_metadata_dictionary(metadata) for metadata in database_manager.classifiers_metadata(user_id)]
+    }
+
+    return jsonString(dic)
+
+
+@app.route('/sensor/<sensor_id>/classifier', methods=['GET'])
+def get_classifier(sensor_id):
+    '''Returns metadata of a virtual sensor's classifier
+
+    Serialized models are not read from the database.
+
+    Args as a part of URL:
+        <sensor_id>: An object ID of a virtual sensor
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "GET"
+            "result": error when the sensor has no classifier, otherwise ok
+            "ret":{
+                "_id": An object ID of the classifier
+                "sensor_id": An object ID of the virtual sensor
+                "user_id": A user ID of a user who own the classifier
+                "model_name": A name of a machine learning model
+                "labels": An array of labels
+                "sampling_period": Seconds of timeseries data used for a prediction
+                "format": A storage format version
+                "raw_bytes": The size of the uncompressed model
+                "stored_bytes": The size of the stored model
+                "compiled_bytes": The size of the compiled forest used for predictions
+                "tuning": A report of the last parameter search, or null
+                    (see giotto.ml.classifier.tuning.search)
+                "training": The mode, sample counts, and fit time of the last training
+                    run (see MLRandomForest.train)
+            }
+        }
+    '''
+    user_id = 'default'
+    dic = {
+        'url':request.url,
+        'method':request.method
+    }
+
+    metadata = database_manager.classifier_metadata(sensor_id, user_id)
+    if metadata is not None:
+        dic['result'] = 'ok'
+        dic['ret'] = classifier_metadata_dictionary(metadata)
+    else:
+        dic['result'] = 'error'
+        dic['message'] = 'A classifier for the sensor not found.'
+
+    return jsonString(dic)
+
+
+@app.route('/classifiers/cache', methods=['GET'])
+def get_classifier_cache_stats():
+    '''Returns statistics of the in-process classifier cache
+
+    Deserialized classifiers are cached in each server process to speed up
+    predictions. Use the counters to size the cache.
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "GET"
+            "result": "ok"
+            "ret":{
+                "capacity": The maximum number of cached classifiers
+                "size": The current number of cached classifiers
+                "hits": The number of lookups served from the cache
+                "misses": The number of lookups not found in the cache
+                "evictions": The number of classifiers evicted from the cache
+                "hit_rate": hits / (hits + misses)
+            }
+        }
+    '''
+    dic = {
+        'url':request.url,
+        'method':request.method,
+        'result':'ok',
+        'ret':database_manager.classifier_cache.stats()
+    }
+
+    return jsonString(dic)
+
+
+@app.route('/timeseries/cache', methods=['GET'])
+def get_timeseries_cache_stats():
+    '''Returns statistics of the local timeseries cache
+
+    Historical timeseries data fetched from BuildingDepot is cached on a local
+    disk and reused by later training runs.
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "GET"
+            "result": "ok", or "error" when the cache is disabled
+            "ret":{
+                "directory": A path to the cache directory
+                "max_bytes": The maximum total size of cached data
+                "bytes": The current total size of cached data
+                "entries": The number of cached queries
+                "hits": The number of queries served from the cache
+                "misses": The number of queries not found in the cache
+                "stores": The number of queries stored in the cache
+                "evictions": The number of queries evicted from the cache
+                "hit_rate": hits / (hits + misses)
+            }
+        }
+    '''
+    dic = {
+        'url':request.url,
+        'method':request.method,
+    }
+
+    cache = database_manager.timeseries_cache()
+    if cache is not None:
+        dic['result'] = 'ok'
+        dic['ret'] = cache.stats()
+    else:
+        dic['result'] = 'error'
+
+    return jsonString(dic)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    '''Returns metrics in the Prometheus text format
+
+    Exposes request counts and latencies per endpoint and latency histograms of
+    processing stages: classifier_load (MongoDB and GridFS reads),
+    classifier_unpickle, buildingdepot_fetch, buildingdepot_poll (the stream
+    ingestor), timeseries_cache_read, preprocess, classifier_predict, and
+    classifier_fit.
+
+    Returns:
+        Metrics as text/plain in the Prometheus exposition format
+    '''
+    response = make_response(metrics.registry.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+
+    return response
+
+
+@app.route('/profiles', methods=['GET'])
+def get_profiles():
+    '''Returns a list of recent request profiles
+
+    A request is profiled when it has an "X-Giotto-Profile: 1" header, or when it
+    is sampled at PROFILE_SAMPLE_RATE. The ID of a profile is returned in the
+    "X-Giotto-Profile-Id" header of the profiled response.
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "GET"
+            "result": "ok"
+            "ret":[
+                {
+                    "profile_id": An ID of a profile
+                    "url": A URL of the profiled request
+                    "method": An HTTP method of the profiled request
+                    "endpoint": A URL rule of the profiled request
+                    "status": An HTTP status code of the profiled response
+                    "started_at": A unix timestamp when the request started
+                    "duration": Seconds spent on the request
+                },
+                { more profiles from the newest to the oldest }
+            ]
+        }
+    '''
+    dic = {
+        'url':request.url,
+        'method':request.method,
+        'result':'ok',
+        'ret':request_profiler.recent()
+    }
+
+    return jsonString(dic)
+
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    '''Returns a request profile with its top hotspots
+
+    Args as a part of URL:
+        <profile_id>: An ID of a profile
+
+    Returns:
+        {
+            "url": A URL of the HTTP call
+            "method": "GET"
+            "result": error when the profile is not found, otherwise ok
+            "ret":{
+                (the fields in /profiles)
+                "hotspots":[
+                    {
+                        "function": "file:line(function)"
+                        "calls": The number of calls
+                        "self_time": Seconds spent in the function itself
+                        "cumulative_time": Seconds spent in the function and its callees
+                    },
+                    { more functions by self time in descending order }
+                ]
+            }
+        }
+    '''
+    dic = {
+        'url':request.url,
+        'method':request.method
+    }
+
+    profile = request_profiler.profile(profile_id)
+    if profile is not None:
+        dic['result'] = 'ok'
+        dic['ret'] = profile.to_dictionary()
+    else:
+        dic['result'] = 'error'
+        dic['message'] = 'The profile not found.'
+
+    return jsonString(dic)
+
+
+@app.route('/profiles/<profile_id>/download', methods=['GET'])
+def download_profile(profile_id):
+    '''Downloads the raw pstats data of a request profile
+
+    The file can be opened with pstats.Stats or a viewer such as snakeviz.
+
+    Args as a part of URL:
+        <profile_id>: An ID of a profile
+
+    Returns:
+        A pstats file as application/octet-stream, or an error JSON when the
+        profile is not found
+    '''
+    profile = request_profiler.profile(profile_id)
+    if profile is None:
+        dic = {
+            'url':request.url,
+            'method':request.method,
+            'result':'error',
+            'message':'The profile not found.'
+        }
+        return jsonString(dic)
+
+    response = make_response(profile.dump())
+    response.headers['Content-Type'] = 'application/octet-stream'
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.prof' % profile_id
+
+    return response
+
+# Importing this module is most of the startup time of a worker and should take
+# at most STARTUP_BUDGET seconds. Database and BuildingDepot clients, caches, and
+# sklearn are loaded on first use, so no server is contacted here.
+# benchmarks/startup.py enforces the budget: it imports this module in fresh
+# processes and fails when the import is over budget. A running worker reports
+# its startup time as the "startup" stage of giotto_stage_duration_seconds.
+STARTUP_BUDGET = 1.0
+startup_time = timeit.default_timer() - import_started
+metrics.stage_duration.observe(startup_time, ('startup',))
+
 
 if __name__=="__main__":
     app.run(host='0.0.0.0', debug=True)